@@ -0,0 +1,18 @@
+"""
+ASGI entry point. Serves the same Flask app through an ASGI server, e.g.
+
+	pip install -r requirements.txt
+	uvicorn asgi:app --port 8080 --workers 2
+
+WsgiToAsgi runs each request on a worker thread pool, so one process
+overlaps separate requests that are blocked on Auth0 or Datastore I/O.
+Within a request the handlers stay synchronous; independent reads overlap
+by going out as one batched lookup, e.g. the assignment PUT/DELETE read the
+milestone, the child and the assignment in a single get_multi inside their
+transaction.
+"""
+from asgiref.wsgi import WsgiToAsgi
+
+import main
+
+app = WsgiToAsgi(main.app)
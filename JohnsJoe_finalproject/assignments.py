@@ -0,0 +1,56 @@
+# Child-milestone assignments, stored as a join kind
+#
+# Each assignment is keyed deterministically under its child:
+#	Key('children', child_id, 'assignments', milestone_id)
+# so assign/unassign/lookup are single keyed operations inside the child's
+# entity group, and no list on a shared milestone has to be scanned or
+# rewritten. The milestone -> children direction is an indexed query on
+# (milestone_id, user_id). Children keep a denormalized milestones_assigned
+# list (written in the same transaction) so a child can be rendered with one
+# read.
+from google.cloud import datastore
+
+from config import client
+
+# Fields of a milestone copied into each assignment and into the child's
+# milestones_assigned entry
+milestone_summary_fields = ['activity', 'age', 'category', 'milestone']
+
+# Compact milestone reference embedded in a child's milestones_assigned
+def milestone_summary(milestone_id, single_milestone):
+	summary = {
+		'id': int(milestone_id),
+		'self': single_milestone['self']
+	}
+	for field in milestone_summary_fields:
+		summary[field] = single_milestone[field]
+	return summary
+
+def assignment_key(child_id, milestone_id):
+	return client.key('children', int(child_id), 'assignments', int(milestone_id))
+
+def build_assignment(single_child, milestone_id, single_milestone):
+	assignment = datastore.Entity(key=assignment_key(single_child.key.id, milestone_id))
+	assignment.update(milestone_summary(milestone_id, single_milestone))
+	assignment.update({
+		'child_id': single_child.key.id,
+		'milestone_id': int(milestone_id),
+		'user_id': single_child['user_id']
+	})
+	return assignment
+
+# Query for the assignments of one milestone, optionally limited to one owner
+def milestone_assignments_query(milestone_id, user_id=None, keys_only=False):
+	query = client.query(kind='assignments')
+	query.add_filter('milestone_id', '=', int(milestone_id))
+	if user_id is not None:
+		query.add_filter('user_id', '=', user_id)
+	if keys_only:
+		query.keys_only()
+	return query
+
+# Keys of every assignment held by one child
+def child_assignment_keys(child_id):
+	query = client.query(kind='assignments', ancestor=client.key('children', int(child_id)))
+	query.keys_only()
+	return [entity.key for entity in query.fetch()]
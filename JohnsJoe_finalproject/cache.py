@@ -0,0 +1,166 @@
+# Read-through cache for the shared milestone catalog
+#
+# The backend is picked from the environment:
+#	CACHE_BACKEND=memory (default)	in-process LRU, per instance
+#	CACHE_BACKEND=redis				any Redis-protocol server at REDIS_URL
+#									(needs the optional redis package)
+# Writes only invalidate the backend of the instance that took them, so
+# deployments with more than one instance need redis.
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import register_collector
+from singleflight import group
+
+# Seconds an entry may be served before it is reloaded from Datastore
+CACHE_TTL = 300
+LRU_SIZE = 2048
+
+class LRUCache(object):
+	def __init__(self, size=LRU_SIZE):
+		self.size = size
+		self._lock = threading.Lock()
+		self._data = OrderedDict()
+
+	def get(self, key):
+		with self._lock:
+			entry = self._data.get(key)
+			if entry is None:
+				return None
+			value, expires_at = entry
+			if expires_at <= time.monotonic():
+				del self._data[key]
+				return None
+			self._data.move_to_end(key)
+			return value
+
+	def set(self, key, value, ttl=CACHE_TTL):
+		with self._lock:
+			self._data[key] = (value, time.monotonic() + ttl)
+			self._data.move_to_end(key)
+			while len(self._data) > self.size:
+				self._data.popitem(last=False)
+
+	def delete(self, *keys):
+		with self._lock:
+			for key in keys:
+				self._data.pop(key, None)
+
+	def incr(self, key):
+		with self._lock:
+			value, expires_at = self._data.get(key, (0, float('inf')))
+			self._data[key] = (value + 1, float('inf'))
+			return value + 1
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+
+class RedisCache(object):
+	def __init__(self, url):
+		try:
+			import redis
+		except ImportError:
+			raise RuntimeError('CACHE_BACKEND=redis requires the redis package (pip install redis)')
+		self._redis = redis.Redis.from_url(url)
+
+	def get(self, key):
+		value = self._redis.get(key)
+		return None if value is None else json.loads(value)
+
+	def set(self, key, value, ttl=CACHE_TTL):
+		self._redis.set(key, json.dumps(value), ex=ttl)
+
+	def delete(self, *keys):
+		if keys:
+			self._redis.delete(*keys)
+
+	def incr(self, key):
+		return self._redis.incr(key)
+
+	def clear(self):
+		self._redis.flushdb()
+
+def make_backend():
+	if os.environ.get('CACHE_BACKEND', 'memory') == 'redis':
+		return RedisCache(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+	return LRUCache()
+
+class ReadThroughCache(object):
+	def __init__(self, backend, name='cache'):
+		self.backend = backend
+		self._flight = group(name)
+		self._lock = threading.Lock()
+		self._stats = {
+			'hits': 0,
+			'misses': 0,
+			'cache_seconds': 0.0,
+			'datastore_seconds': 0.0
+		}
+
+	def _record(self, **deltas):
+		with self._lock:
+			for name, delta in deltas.items():
+				self._stats[name] += delta
+
+	# Returns the cached value for key, or calls loader() and caches its
+	# result. None results are not cached. Concurrent misses on the same
+	# key share one loader() call.
+	def get_or_load(self, key, loader):
+		start = time.perf_counter()
+		value = self.backend.get(key)
+		elapsed = time.perf_counter() - start
+		if value is not None:
+			self._record(hits=1, cache_seconds=elapsed)
+			return value
+
+		start = time.perf_counter()
+		value = self._flight.do(key, loader)
+		self._record(misses=1, cache_seconds=elapsed, datastore_seconds=time.perf_counter() - start)
+		if value is not None:
+			self.backend.set(key, value)
+		return value
+
+	def stats(self):
+		with self._lock:
+			stats = dict(self._stats)
+		lookups = stats['hits'] + stats['misses']
+		stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+		stats['avg_cache_ms'] = stats['cache_seconds'] * 1000 / lookups if lookups else 0.0
+		stats['avg_datastore_ms'] = stats['datastore_seconds'] * 1000 / stats['misses'] if stats['misses'] else 0.0
+		stats['backend'] = type(self.backend).__name__
+		return stats
+
+milestone_cache = ReadThroughCache(make_backend(), 'milestone_cache')
+
+@register_collector
+def _milestone_cache_metrics():
+	stats = milestone_cache.stats()
+	return [
+		('milestone_cache_hits_total', 'counter', 'Milestone reads served from the cache.', stats['hits']),
+		('milestone_cache_misses_total', 'counter', 'Milestone reads that went to Datastore.', stats['misses']),
+		('milestone_cache_hit_ratio', 'gauge', 'Share of milestone reads served from the cache.', stats['hit_ratio']),
+		('milestone_cache_seconds_total', 'counter', 'Time spent in cache lookups.', stats['cache_seconds']),
+		('milestone_cache_datastore_seconds_total', 'counter', 'Time spent loading cache misses from Datastore.', stats['datastore_seconds']),
+	]
+
+# Cache keys. Every key includes a generation number, so bumping it
+# invalidates every cached milestone and page at once. A load that started
+# before a write stores its result under the old generation, where no
+# later read looks for it.
+def _generation():
+	return milestone_cache.backend.get('milestones:gen') or 0
+
+def milestone_key(milestone_id):
+	return 'milestone:' + str(_generation()) + ':' + str(milestone_id)
+
+def milestone_list_key(*parts):
+	return 'milestones:page:' + str(_generation()) + ':' + ':'.join(str(part) for part in parts)
+
+# Drops the cached milestones and every cached list page
+def invalidate_milestones(*milestone_ids):
+	milestone_cache.backend.delete(*[milestone_key(milestone_id) for milestone_id in milestone_ids])
+	milestone_cache.backend.incr('milestones:gen')
@@ -1,14 +1,91 @@
 # Routing functions for children entity
 from flask import Blueprint, request
 from google.cloud import datastore
-import json
 
-from helpers import verify_jwt, verify_content_type
-
-client = datastore.Client()
+from helpers import verify_jwt, verify_content_type, fetch_page, new_key, new_keys, get_multi_ordered, get_shared, run_in_transaction, TXN_ENTITY_GROUPS
+from helpers import put_multi_chunked, delete_multi_chunked, validate_batch, ndjson_response, json_response
+from helpers import touch, entity_etag, list_etag, not_modified, cache_headers, PRIVATE_CACHE_CONTROL
+from assignments import milestone_summary, milestone_summary_fields, assignment_key, build_assignment, child_assignment_keys
+from progress import adjust_child_progress, child_progress
+from tasks import task, enqueue
+from config import client
 
 bp = Blueprint('children', __name__, url_prefix='/children')
 
+# Collection-level custom methods (/children:batch) sit beside the prefix
+bulk_bp = Blueprint('children_bulk', __name__)
+
+child_required_headers = ['first_name', 'gender', 'birthday']
+
+# Child as returned by the API. milestones_assigned holds just id/self
+# unless the client asked for ?expand=milestones.
+def format_child(single_child, child_id, expand=None):
+	formatted = dict(single_child)
+	formatted['id'] = child_id
+	formatted.pop('progress', None)
+	if expand != 'milestones':
+		formatted['milestones_assigned'] = [{'id': e['id'], 'self': e['self']} for e in single_child['milestones_assigned']]
+	return formatted
+
+# Builds a new child entity owned by user_id from a validated request body
+def build_child(key, body, user_id, base_url):
+	new_child = datastore.Entity(key=key)
+	new_child.update({
+		'first_name': body['first_name'],
+		'gender': body['gender'],
+		'birthday': body['birthday'],
+		'user_id': user_id,
+		'milestones_assigned': [],
+		'progress': [],
+		'self': base_url + '/' + str(key.id),
+		'version': 1
+	})
+	return new_child
+
+# Tasks keeping the owner's children list in step. Each one re-reads the
+# user in a transaction and is safe to run more than once.
+@task('add_children_to_user')
+def add_children_to_user(payload):
+	# Children are read in the same transaction as the user, so one deleted
+	# before or while the task runs is not added back. The user takes one of
+	# the TXN_ENTITY_GROUPS entity groups of each transaction.
+	size = TXN_ENTITY_GROUPS - 1
+	for start in range(0, len(payload['children']), size):
+		chunk = payload['children'][start:start + size]
+		child_keys = [client.key('children', e['child_id']) for e in chunk]
+		
+		def append():
+			single_user = client.get(key=client.key('users', payload['user_id']))
+			if single_user is None:
+				return
+			existing = set(e.key.id for e in get_multi_ordered(client, child_keys) if e is not None)
+			listed = set(e['child_id'] for e in single_user['children'])
+			missing = [e for e in chunk if e['child_id'] in existing and e['child_id'] not in listed]
+			if missing:
+				single_user['children'].extend(missing)
+				client.put(single_user)
+		run_in_transaction(client, append)
+
+def enqueue_add_children(user_id, new_children):
+	children = [{'child_id': e.key.id, 'self': e['self']} for e in new_children]
+	enqueue('add_children_to_user', {'user_id': user_id, 'children': children}, task_id='add-children-' + str(children[0]['child_id']))
+
+@task('remove_child_from_user')
+def remove_child_from_user(payload):
+	def remove():
+		single_user = client.get(key=client.key('users', payload['user_id']))
+		if single_user is None:
+			return
+		remaining = [e for e in single_user['children'] if e['child_id'] != payload['child_id']]
+		if len(remaining) != len(single_user['children']):
+			single_user['children'] = remaining
+			client.put(single_user)
+	run_in_transaction(client, remove)
+
+@task('delete_child_assignments')
+def delete_child_assignments(payload):
+	delete_multi_chunked(client, child_assignment_keys(payload['child_id']))
+
 # Routing function for getting and adding children to the database
 @bp.route('', methods = ['GET', 'POST'])
 def children_get_post():
@@ -17,31 +94,18 @@ def children_get_post():
 		payload = verify_jwt(request)
 		
 		if not payload:
-			return json.dumps([]), 200, {'Content-Type':'application/json'} 
+			return json_response([])
 		
+		# Only the owner's children, served by the (user_id, first_name) index
 		query = client.query(kind='children')
+		query.add_filter('user_id', '=', payload['sub'])
+		query.order = ['first_name']
 		
-		# Setting pagination 
-		q_limit = 5
-		q_offset = int(request.args.get('offset', '0'))
-		l_iterator = query.fetch(limit = q_limit, offset = q_offset)
-
-		# Get pages variable and list of children
-		pages = l_iterator.pages
-		all_children = list(next(pages))
-		
-		# If more children are on next page set next_url, else no more pages
-		if l_iterator.next_page_token:
-			next_offset = q_offset + q_limit
-			next_url = request.base_url + "?offset=" + str(next_offset)
-		else:
-			next_url = None
+		# Get one page of children and the cursor for the next one
+		all_children, next_url, next_token = fetch_page(query, request)
 		
-		# Set id for each milestone\
-		all_children = [e for e in all_children if e['user_id'] == payload['sub']]
-
-		for e in all_children:
-			e["id"] = e.key.id
+		# Set id for each child
+		all_children = [format_child(e, e.key.id, request.args.get('expand')) for e in all_children]
 		
 		# Format children appropriately 
 		all_children_formatted = {
@@ -51,57 +115,37 @@ def children_get_post():
 		# Set next_url if is not None
 		if next_url:
 			all_children_formatted['next'] = next_url
+			all_children_formatted['next_page_token'] = next_token
+		
+		etag = list_etag('children', all_children, next_token, request.args.get('expand', ''))
+		unchanged = not_modified(etag, PRIVATE_CACHE_CONTROL)
+		if unchanged:
+			return unchanged
 
-		return json.dumps(all_children_formatted), 200, {'Content-Type':'application/json'} 
+		return json_response(all_children_formatted, 200, cache_headers(etag, PRIVATE_CACHE_CONTROL))
 	elif request.method == 'POST':
 		verify_content_type(request)		
 		payload = verify_jwt(request)
 
 		body = request.get_json()
-
-		child_required_headers = ['first_name', 'gender', 'birthday']
 		
 		if not set(child_required_headers).issubset(body.keys()):
-			return json.dumps({'Error': 'The request object is missing at least one of the required attributes.'}), 400, {'Content-Type':'application/json'}  
-		
-		# Set up entity and add to client
-		new_child = datastore.Entity(key=client.key('children'))
-		new_child.update({
-			'first_name': body['first_name'],
-			'gender': body['gender'],
-			'birthday': body['birthday'],
-			'user_id': payload['sub'],
-			'milestones_assigned': []
-		})
-		client.put(new_child)
+			return json_response({'Error': 'The request object is missing at least one of the required attributes.'}, 400)
 		
-		# Update with self url and return with id
-		new_child.update({
-			'self': request.base_url + '/' + str(new_child.key.id)
-		})
-		client.put(new_child)
-		
-		new_child['id'] = new_child.key.id
-		
-		# Add child to user account in entity
-		query = client.query(kind='users')
-		query.add_filter('user_id', '=', payload['sub'])
-		single_user = list(query.fetch())[0]
-			
-		# Make sure user exists
-		if single_user == None:
-			return jsonify({"Error": "No user with this user_id exists."}), 404, {'Content-Type':'application/json'} 
+		# Make sure user exists before writing anything
+		if get_shared(client, client.key('users', payload['sub'])) == None:
+			return json_response({"Error": "No user with this user_id exists."}, 404)
 		
-		single_user['children'].append({
-			'child_id': new_child.key.id,
-			'self': request.base_url + '/' + str(new_child.key.id)
-			})
+		# Set up entity with a preallocated id and add to client
+		new_child = build_child(new_key(client, 'children'), body, payload['sub'], request.base_url)
+		client.put(new_child)
 		
-		client.put(single_user)
+		# Add child to user account in entity, off the request path
+		enqueue_add_children(payload['sub'], [new_child])
 		
-		return json.dumps(new_child), 201, {'Content-Type':'application/json'} 
+		return json_response(format_child(new_child, new_child.key.id, request.args.get('expand')), 201)
 	else:
-		return json.dumps({'Error': 'This API does not support this operation.'}), 405, {'Content-Type': 'application/json'}
+		return json_response({'Error': 'This API does not support this operation.'}, 405)
 
 # Route information for getting and deleting a child based on its ID
 @bp.route('/<child_id>', methods = ['GET', 'DELETE'])
@@ -115,14 +159,19 @@ def children_get_delete(child_id):
 		
 		# If child does not exist, else return child information
 		if single_child == None:
-			return json.dumps({"Error": "No child with this child_id exists."}), 404, {'Content-Type':'application/json'} 
+			return json_response({"Error": "No child with this child_id exists."}, 404)
 		
 		# If jwt is not user for child, return error
 		if single_child['user_id'] != payload['sub']:
-			return json.dumps({'Error': 'You do not have authorization to view this child.'}), 401, {'Content-Type':'application/json'}
+			return json_response({'Error': 'You do not have authorization to view this child.'}, 401)
+		
+		# Unchanged children are answered without serializing the body
+		etag = entity_etag('children', child_id, single_child, request.args.get('expand', ''))
+		unchanged = not_modified(etag, PRIVATE_CACHE_CONTROL)
+		if unchanged:
+			return unchanged
 				
-		single_child['id'] = child_id
-		return json.dumps(single_child), 200, {'Content-Type':'application/json'} 
+		return json_response(format_child(single_child, child_id, request.args.get('expand')), 200, cache_headers(etag, PRIVATE_CACHE_CONTROL))
 	elif request.method == 'DELETE':
 		verify_content_type(request)
 		payload = verify_jwt(request)
@@ -132,38 +181,23 @@ def children_get_delete(child_id):
 		
 		# If child does not exist, else return child information
 		if single_child == None:
-			return json.dumps({"Error": "No child with this child_id exists."}), 404, {'Content-Type':'application/json'} 
+			return json_response({"Error": "No child with this child_id exists."}, 404)
 		
 		# If jwt is not user for child, return error
 		if single_child['user_id'] != payload['sub']:
-			return json.dumps({'Error': 'You do not have authorization to view this child.'}), 401, {'Content-Type':'application/json'}
+			return json_response({'Error': 'You do not have authorization to view this child.'}, 401)
 		
-		# If child exists, remove child information from milestones
-		for element in single_child['milestones_assigned']:
-			milestone_key = client.key('milestones', int(element['id']))
-			single_milestone = client.get(key=milestone_key)
-			single_milestone['children_id_assigned'].remove(int(child_id))
-			client.put(single_milestone)
-		
-		# Remove child from user list in users entity
-		query = client.query(kind='users')
-		query.add_filter('user_id', '=', payload['sub'])
-		single_user = list(query.fetch())[0]
-			
 		# Make sure user exists
-		if single_user == None:
-			return jsonify({"Error": "No user with this user_id exists."}), 404, {'Content-Type':'application/json'} 
-
-		single_user['children'].remove({
-			'child_id': int(child_id),
-			'self': request.base_url
-			}
-		)
-		
-		client.put(single_user)
+		user_key = client.key('users', payload['sub'])
+		if get_shared(client, user_key) == None:
+			return json_response({"Error": "No user with this user_id exists."}, 404)
 		
+		# Assignments live under the child, so no milestone has to change.
+		# The user's list and the assignments are cleaned up by tasks.
 		client.delete(child_key)
-		return {}, 204, {'Content-Type':'application/json'} 
+		enqueue('remove_child_from_user', {'user_id': payload['sub'], 'child_id': int(child_id)}, task_id='remove-child-' + str(child_id))
+		enqueue('delete_child_assignments', {'child_id': int(child_id)}, task_id='delete-assignments-' + str(child_id))
+		return json_response({}, 204)
 
 # Routing function for adding or removing a milestone from a child
 @bp.route('/<child_id>/milestones/<milestone_id>', methods = ['PUT', 'DELETE'])
@@ -173,69 +207,64 @@ def children_add_remove_milestone(milestone_id, child_id):
 		payload = verify_jwt(request)
 		
 		milestone_key = client.key('milestones', int(milestone_id))
-		single_milestone = client.get(key=milestone_key)
-		
 		child_key = client.key('children', int(child_id))
-		single_child = client.get(key=child_key)
-		
-		# Check if milestone or child do not exist
-		if not single_milestone or not single_child:
-			return json.dumps({'Error': 'The specified milestone and/or child does not exist.'}), 404, {'Content-Type':'application/json'}
 		
-		# If the milestone is already assigned to a child
-		for element in single_child['milestones_assigned']:
-			if single_milestone.key.id == element['id']:
-				return json.dumps({'Error': 'This milestone is already assigned to the child.'}), 403, {'Content-Type':'application/json'}
-		
-		# Add milestone information to child and add to database
-		single_child['milestones_assigned'].append({
-			'id': int(milestone_id),
-			'self': single_milestone['self']
-		})
-		
-		client.put(single_child)
-		
-		single_milestone['children_id_assigned'].append(int(child_id))
-		
-		client.put(single_milestone)
-		
-		return {}, 204, {'Content-Type':'application/json'}
+		# Milestone, child and assignment are read in one lookup inside the
+		# transaction, so a concurrent assignment to the same child or a
+		# delete of the milestone aborts the commit and the checks are re-run
+		def assign():
+			single_milestone, single_child, assignment = get_multi_ordered(client, [milestone_key, child_key, assignment_key(child_id, milestone_id)])
+			
+			# Check if milestone or child do not exist
+			if not single_milestone or not single_child:
+				return {'Error': 'The specified milestone and/or child does not exist.'}, 404
+			
+			# If jwt is not user for child, return error
+			if single_child['user_id'] != payload['sub']:
+				return {'Error': 'You do not have authorization to view this child.'}, 401
+			
+			# If the milestone is already assigned to a child
+			if assignment:
+				return {'Error': 'This milestone is already assigned to the child.'}, 403
+			
+			# Write the assignment and the child's summary list together
+			summary = milestone_summary(milestone_id, single_milestone)
+			single_child['milestones_assigned'].append(summary)
+			adjust_child_progress(single_child, summary, 1)
+			client.put_multi([build_assignment(single_child, milestone_id, single_milestone), touch(single_child)])
+			return {}, 204
+		
+		return json_response(*run_in_transaction(client, assign))
 	elif request.method == 'DELETE':
 		verify_content_type(request)
 		payload = verify_jwt(request)
-		
 		milestone_key = client.key('milestones', int(milestone_id))
-		single_milestone = client.get(key=milestone_key)
-		
 		child_key = client.key('children', int(child_id))
-		single_child = client.get(key=child_key)
 		
-		# Check if milestone or child does not exist
-		if not single_milestone or not single_child:
-			return json.dumps({'Error': 'The specified milestone and/or child does not exist.'}), 404, {'Content-Type':'application/json'}
-		
-		# If jwt is not user for child, return error
-		if single_child['user_id'] != payload['sub']:
-			return json.dumps({'Error': 'You do not have authorization to view this child.'}), 401, {'Content-Type':'application/json'}
+		def unassign():
+			single_milestone, single_child, assignment = get_multi_ordered(client, [milestone_key, child_key, assignment_key(child_id, milestone_id)])
 			
-		# If the milestone is not assigned to this child
-		if int(child_id) not in single_milestone['children_id_assigned']:
-			return json.dumps({'Error': 'No milestone with this milestone_id is assigned to the child with this child_id.'}), 404, {'Content-Type': 'application/json'}
-		
-		# Delete milestone from child
-		single_child['milestones_assigned'].remove({
-			'id': int(milestone_id),
-			'self': single_milestone['self']
-		})
-		
-		client.put(single_child)
-
-		# Remove children assigned
-		single_milestone['children_id_assigned'].remove(int(child_id))
-		
-		client.put(single_milestone)
-		
-		return {}, 204, {'Content-Type':'application/json'}
+			# Check if milestone or child does not exist
+			if not single_milestone or not single_child:
+				return {'Error': 'The specified milestone and/or child does not exist.'}, 404
+			
+			# If jwt is not user for child, return error
+			if single_child['user_id'] != payload['sub']:
+				return {'Error': 'You do not have authorization to view this child.'}, 401
+				
+			# If the milestone is not assigned to this child
+			if not assignment:
+				return {'Error': 'No milestone with this milestone_id is assigned to the child with this child_id.'}, 404
+			
+			# Delete the assignment and drop the milestone from the child's list
+			for entry in [e for e in single_child['milestones_assigned'] if e['id'] == int(milestone_id)]:
+				adjust_child_progress(single_child, entry, -1)
+			single_child['milestones_assigned'] = [e for e in single_child['milestones_assigned'] if e['id'] != int(milestone_id)]
+			client.delete(assignment.key)
+			client.put(touch(single_child))
+			return {}, 204
+		
+		return json_response(*run_in_transaction(client, unassign))
 
 # Routing function for getting all children from a milestone
 @bp.route('/<child_id>/milestones', methods = ['GET'])
@@ -249,19 +278,98 @@ def get_childs_from_milestone(child_id):
 		
 		# If no milestone with id
 		if not single_child:
-			return json.dumps({'Error': 'No child with this child_id exists.'}), 404, {'Content-Type':'application/json'}
+			return json_response({'Error': 'No child with this child_id exists.'}, 404)
 			
 		# If jwt is not user for child, return error
 		if single_child['user_id'] != payload['sub']:
-			return json.dumps({'Error': 'You do not have authorization to view this child.'}), 401, {'Content-Type':'application/json'}
-		
+			return json_response({'Error': 'You do not have authorization to view this child.'}, 401)
+		
+		# Milestone summaries are embedded in the child, so no extra reads;
+		# entries written before summaries were embedded are looked up in one batch
+		legacy = [e for e in single_child['milestones_assigned'] if not set(milestone_summary_fields).issubset(e.keys())]
+		headers = None
+		if not legacy:
+			# The list only changes when the child does
+			etag = entity_etag('children', child_id, single_child, '-milestones')
+			unchanged = not_modified(etag, PRIVATE_CACHE_CONTROL)
+			if unchanged:
+				return unchanged
+			headers = cache_headers(etag, PRIVATE_CACHE_CONTROL)
+		
+		milestone_keys = [client.key('milestones', int(milestone['id'])) for milestone in legacy]
+		looked_up = dict((milestone['id'], single_milestone) for milestone, single_milestone in zip(legacy, get_multi_ordered(client, milestone_keys)))
+		
+		# One pass in assignment order, filling legacy entries from the lookup
 		results = []
-		
-		# Get all milestones information assigned to child
 		for milestone in single_child['milestones_assigned']:
-			milestone_key = client.key('milestones', int(milestone['id']))
-			single_milestone = client.get(key=milestone_key)
-			single_milestone['id'] = milestone['id']
-			results.append(single_milestone)
-			
-		return json.dumps(results), 200, {'Content-Type':'application/json'}
\ No newline at end of file
+			if milestone['id'] not in looked_up:
+				results.append(milestone)
+			# Skip references to milestones that no longer exist
+			elif looked_up[milestone['id']] is not None:
+				results.append(milestone_summary(milestone['id'], looked_up[milestone['id']]))
+		
+		return json_response(results, 200, headers)
+
+# Routing function for a child's milestones done out of the catalog, per
+# category and age band, read from precomputed counters
+@bp.route('/<child_id>/progress', methods = ['GET'])
+def children_get_progress(child_id):
+	verify_content_type(request)
+	payload = verify_jwt(request)
+	
+	single_child = client.get(key=client.key('children', int(child_id)))
+	
+	# If no child with id
+	if not single_child:
+		return json_response({'Error': 'No child with this child_id exists.'}, 404)
+		
+	# If jwt is not user for child, return error
+	if single_child['user_id'] != payload['sub']:
+		return json_response({'Error': 'You do not have authorization to view this child.'}, 401)
+	
+	progress = child_progress(single_child)
+	progress['id'] = int(child_id)
+	progress['self'] = request.base_url
+	return json_response(progress)
+
+# Creates many children for the caller in one request, reporting a result per item
+@bulk_bp.route('/children:batch', methods = ['POST'])
+def children_batch():
+	verify_content_type(request)
+	payload = verify_jwt(request)
+	items = validate_batch(request.get_json(), child_required_headers)
+	
+	# Make sure user exists before writing anything
+	single_user = get_shared(client, client.key('users', payload['sub']))
+	if single_user == None:
+		return json_response({"Error": "No user with this user_id exists."}, 404)
+	
+	valid = [(index, item) for index, item, error in items if error is None]
+	keys = new_keys(client, 'children', len(valid))
+	base_url = request.url_root + 'children'
+	new_children = [build_child(key, item, payload['sub'], base_url) for key, (index, item) in zip(keys, valid)]
+	put_multi_chunked(client, new_children)
+	
+	# Add all new children to the user account with a single task
+	if new_children:
+		enqueue_add_children(payload['sub'], new_children)
+	
+	created = dict((index, child) for (index, item), child in zip(valid, new_children))
+	results = []
+	for index, item, error in items:
+		if error:
+			results.append({'index': index, 'status': 400, 'Error': error})
+		else:
+			results.append({'index': index, 'status': 201, 'id': created[index].key.id, 'self': created[index]['self']})
+	
+	return json_response({'results': results})
+
+# Streams every child owned by the caller as newline-delimited JSON
+@bulk_bp.route('/children:export', methods = ['GET'])
+def children_export():
+	payload = verify_jwt(request)
+	
+	query = client.query(kind='children')
+	query.add_filter('user_id', '=', payload['sub'])
+	expand = request.args.get('expand')
+	return ndjson_response(query, lambda e: format_child(e, e.key.id, expand))
\ No newline at end of file
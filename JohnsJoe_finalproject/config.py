@@ -0,0 +1,49 @@
+# Shared configuration and Datastore client, created on first use
+#
+# Importing this module does no I/O: the Auth0 config file is read the first
+# time a value is needed, and a single Datastore client (with its gRPC
+# channel) is created the first time `client` is used, then shared by every
+# module and request thread. Its calls are counted by metrics.py.
+import hashlib
+import hmac
+import json
+import os
+import threading
+from functools import lru_cache
+
+from google.cloud import datastore
+from werkzeug.local import LocalProxy
+
+from metrics import instrument_client
+
+AUTH0_CONFIG_FILE = 'osu.us.auth0.json'
+
+# Open secret client data once per process
+@lru_cache(maxsize=None)
+def auth0_config():
+	with open(AUTH0_CONFIG_FILE) as f:
+		return json.load(f)
+
+# Key that signs session cookies. It must be the same on every instance and
+# across restarts, so it comes from SECRET_KEY or, failing that, is derived
+# from the Auth0 client secret every instance already shares.
+@lru_cache(maxsize=None)
+def secret_key():
+	key = os.environ.get('SECRET_KEY')
+	if key:
+		return key
+	return hmac.new(auth0_config()['client_secret'].encode('utf-8'), b'flask-session', hashlib.sha256).hexdigest()
+
+_client_lock = threading.Lock()
+_client = None
+
+def get_client():
+	global _client
+	if _client is None:
+		with _client_lock:
+			if _client is None:
+				_client = instrument_client(datastore.Client())
+	return _client
+
+# Module-level handle that resolves to the shared client on each use
+client = LocalProxy(get_client)
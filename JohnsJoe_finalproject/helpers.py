@@ -1,16 +1,98 @@
 # Helper functions for milestones.py and children.py
+import copy
+import gzip
+import hashlib
 import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from six.moves.urllib.parse import urlencode
 from six.moves.urllib.request import urlopen
 from jose import jwt
-from flask import Blueprint, jsonify
+from flask import Blueprint, Response, jsonify, request as current_request
+from google.api_core import exceptions as api_exceptions
+from google.cloud import datastore
+from werkzeug.http import unquote_etag
 
-# Open secret client data 
-with open('osu.us.auth0.json') as f:
-	json_file = json.load(f)
+from config import auth0_config
+from metrics import record_jwks_fetch, register_collector
+from singleflight import group
+
+# Optional faster encoders; the stdlib json module is used without orjson,
+# and only gzip is offered without brotli
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
 
 ALGORITHMS = ["RS256"]
-CLIENT_ID = json_file['client_id']
-DOMAIN = json_file['domain']
+
+# JWKS_URL can point at a local stub when load testing; by default it is
+# derived from the Auth0 domain
+JWKS_URL = os.environ.get('JWKS_URL')
+
+# JWKS cache settings (seconds). Keys are refreshed every JWKS_TTL, and at
+# most one fetch is attempted per JWKS_MIN_REFRESH window, whether for an
+# unknown kid or after a failed fetch, during which cached keys are served.
+# Within JWKS_REFRESH_AHEAD of expiry the refresh runs in the background so
+# requests keep using the current keys instead of waiting on Auth0.
+JWKS_TTL = 600
+JWKS_REFRESH_AHEAD = 60
+JWKS_MIN_REFRESH = 30
+JWKS_FETCH_TIMEOUT = 5
+
+# Verified-token cache settings. Entries expire at the token's exp claim, or
+# after TOKEN_CACHE_MAX_AGE seconds for tokens without one.
+TOKEN_CACHE_SIZE = 1024
+TOKEN_CACHE_MAX_AGE = 300
+
+# Ids are reserved with allocate_ids this many at a time per kind
+ID_BLOCK_SIZE = 50
+
+# Cache-Control for the shared milestone catalog and for per-user resources
+CATALOG_CACHE_CONTROL = 'public, max-age=60'
+PRIVATE_CACHE_CONTROL = 'private, no-cache'
+
+# Response bodies at least this large are compressed when the client allows it
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+# Datastore lookups accept at most this many keys per call, and writes at
+# most MAX_WRITE_ENTITIES entities
+MAX_LOOKUP_KEYS = 1000
+MAX_WRITE_ENTITIES = 500
+
+# Batch endpoints accept at most this many items per request; exports read
+# the kind EXPORT_PAGE_SIZE entities at a time
+MAX_BATCH_ITEMS = 5000
+EXPORT_PAGE_SIZE = 500
+
+# Cascading reference updates are committed this many entity groups per
+# transaction. Fan-outs larger than FANOUT_ASYNC_THRESHOLD run in the
+# background and the request returns 202; set it to None to always block.
+TXN_ENTITY_GROUPS = 25
+FANOUT_ASYNC_THRESHOLD = 100
+
+# Transactions aborted by contention are retried up to TXN_RETRIES times,
+# backing off exponentially from TXN_BACKOFF seconds (with full jitter) up
+# to TXN_MAX_BACKOFF
+TXN_RETRIES = 5
+TXN_BACKOFF = 0.05
+TXN_MAX_BACKOFF = 1.0
+
+# List endpoint page sizes; clients may pick up to MAX_PAGE_SIZE with ?limit=
+DEFAULT_PAGE_SIZE = 5
+MAX_PAGE_SIZE = 100
 
 bp = Blueprint('errors', __name__)
 
@@ -25,11 +107,431 @@ def handle_auth_error(ex):
     response.status_code = ex.status_code
     return response
 	
+# Encodes obj as UTF-8 JSON bytes. datastore.Entity is a dict subclass, so
+# both encoders serialize entities directly without copying them to dicts.
+if orjson is not None:
+	def dumps_bytes(obj):
+		return orjson.dumps(obj)
+else:
+	def dumps_bytes(obj):
+		return json.dumps(obj).encode('utf-8')
+
+# Compresses body with the best encoding the client accepts, if any
+def _compress(body):
+	if len(body) < COMPRESS_MIN_BYTES:
+		return body, None
+	encodings = current_request.accept_encodings
+	if brotli is not None and encodings['br']:
+		return brotli.compress(body, quality=BROTLI_QUALITY), 'br'
+	if encodings['gzip']:
+		return gzip.compress(body, compresslevel=GZIP_LEVEL), 'gzip'
+	return body, None
+
+# Builds a JSON response, compressing large bodies when the client allows it
+def json_response(obj, status=200, headers=None):
+	body = b'' if status == 204 else dumps_bytes(obj)
+	response = Response(body, status, headers, content_type='application/json')
+	if body:
+		body, encoding = _compress(body)
+		if encoding:
+			response.set_data(body)
+			response.headers['Content-Encoding'] = encoding
+		response.vary.add('Accept-Encoding')
+	return response
+
+# Bumps the update counter of a milestone or child before it is written
+def touch(entity):
+	entity['version'] = entity.get('version', 0) + 1
+	return entity
+
+# Strong ETag for a single entity, from its update counter. extra
+# distinguishes representations of the same entity (e.g. ?expand=).
+def entity_etag(kind, entity_id, entity, extra=''):
+	return '"%s-%s-%d%s"' % (kind, entity_id, entity.get('version', 0), extra)
+
+# Strong ETag for a list page, from the ids and update counters it holds
+def list_etag(kind, entities, next_token=None, extra=''):
+	digest = hashlib.sha1()
+	for entity in entities:
+		digest.update(('%s:%d;' % (entity['id'], entity.get('version', 0))).encode('utf-8'))
+	digest.update(('%s|%s' % (next_token, extra)).encode('utf-8'))
+	return '"%s-%s"' % (kind, digest.hexdigest())
+
+# Returns a 304 response if the client already holds etag, else None.
+# If-None-Match is parsed into unquoted tags, so compare without quotes.
+def not_modified(etag, cache_control):
+	if not current_request.if_none_match.contains(unquote_etag(etag)[0]):
+		return None
+	response = Response(status=304)
+	response.headers['ETag'] = etag
+	response.headers['Cache-Control'] = cache_control
+	return response
+
+def cache_headers(etag, cache_control):
+	return {'ETag': etag, 'Cache-Control': cache_control}
+
 def verify_content_type(request):
 	# Accept/content types must be json or html, 406 if not
 	if not request.accept_mimetypes['application/json'] or str(request.headers.get('Content-Type', 'application/json')) != 'application/json':
 		raise AuthError({'Error': 'This API only supports JSON request and return objects.'}, 406)
 
+def page_size(request):
+	try:
+		q_limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+	except ValueError:
+		q_limit = 0
+	if q_limit < 1:
+		raise AuthError({'Error': 'The limit parameter must be a positive integer.'}, 400)
+	return min(q_limit, MAX_PAGE_SIZE)
+
+# Fetches one page of query results. Pages are addressed by an opaque
+# ?page_token= cursor; the old ?offset= links still work as a fallback.
+# Returns the entities, the next page url (or None) and the cursor itself.
+def fetch_page(query, request):
+	q_limit = page_size(request)
+	page_token = request.args.get('page_token')
+	try:
+		if page_token:
+			l_iterator = query.fetch(limit = q_limit, start_cursor = page_token)
+		else:
+			q_offset = int(request.args.get('offset', '0'))
+			l_iterator = query.fetch(limit = q_limit, offset = q_offset)
+
+		# Get pages variable and list of entities
+		pages = l_iterator.pages
+		entities = list(next(pages))
+	except (ValueError, api_exceptions.BadRequest):
+		raise AuthError({'Error': 'The page_token or offset parameter is invalid.'}, 400)
+
+	# If more entities are on next page set next_url, else no more pages
+	next_token = l_iterator.next_page_token
+	if not next_token:
+		return entities, None, None
+	if isinstance(next_token, bytes):
+		next_token = next_token.decode('ascii')
+
+	args = [(k, v) for k, v in request.args.items(multi=True) if k not in ('offset', 'page_token')]
+	args.append(('page_token', next_token))
+	next_url = request.base_url + "?" + urlencode(args)
+	return entities, next_url, next_token
+
+# Pools of preallocated keys, per kind
+_id_lock = threading.Lock()
+_id_pools = {}
+
+# Returns a complete key for a new entity of kind, so its id (and self url)
+# is known before the entity's first and only put
+def new_key(client, kind):
+	with _id_lock:
+		pool = _id_pools.get(kind)
+		if not pool:
+			pool = list(client.allocate_ids(client.key(kind), ID_BLOCK_SIZE))
+			pool.reverse()
+			_id_pools[kind] = pool
+		return pool.pop()
+
+# Returns count complete keys for new entities of kind in one allocate_ids call
+def new_keys(client, kind, count):
+	if count == 0:
+		return []
+	return list(client.allocate_ids(client.key(kind), count))
+
+# Batched lookup of many keys. Returns entities in the same order as keys,
+# with None in place of any key that does not exist.
+def get_multi_ordered(client, keys):
+	found = {}
+	for start in range(0, len(keys), MAX_LOOKUP_KEYS):
+		for entity in client.get_multi(keys[start:start + MAX_LOOKUP_KEYS]):
+			found[entity.key] = entity
+	return [found.get(key) for key in keys]
+
+# Concurrent non-transactional lookups of the same key share one RPC
+_shared_reads = group('datastore_get')
+
+def copy_entity(entity):
+	if entity is None:
+		return None
+	copied = datastore.Entity(key=entity.key, exclude_from_indexes=tuple(entity.exclude_from_indexes))
+	copied.update(copy.deepcopy(dict(entity)))
+	return copied
+
+# client.get for request handlers: identical reads already in flight in
+# another thread are joined instead of repeated, and each caller gets its
+# own copy. Inside a transaction it is a plain client.get.
+# A joined read may have started before the caller's own write committed,
+# so it can return the entity as it was before that write. Owner-scoped
+# reads that must see the caller's writes, like the child routes, use
+# client.get instead.
+def get_shared(client, key):
+	if client.current_transaction is not None:
+		return client.get(key=key)
+	flight_key = (key.project, key.namespace, key.flat_path)
+	return _shared_reads.do(flight_key, lambda: client.get(key=key), copy_entity)
+
+def put_multi_chunked(client, entities):
+	for start in range(0, len(entities), MAX_WRITE_ENTITIES):
+		client.put_multi(entities[start:start + MAX_WRITE_ENTITIES])
+
+def delete_multi_chunked(client, keys):
+	for start in range(0, len(keys), MAX_WRITE_ENTITIES):
+		client.delete_multi(keys[start:start + MAX_WRITE_ENTITIES])
+
+# Reads the items of a batch request body (a JSON list). Returns one
+# (index, item, error) tuple per item; error is None when the item has every
+# attribute in required_headers.
+def validate_batch(body, required_headers):
+	if not isinstance(body, list) or not body:
+		raise AuthError({'Error': 'The request body must be a non-empty JSON list.'}, 400)
+	if len(body) > MAX_BATCH_ITEMS:
+		raise AuthError({'Error': 'A batch may contain at most ' + str(MAX_BATCH_ITEMS) + ' items.'}, 413)
+
+	results = []
+	for index, item in enumerate(body):
+		if not isinstance(item, dict) or not set(required_headers).issubset(item.keys()):
+			results.append((index, item, 'The request object is missing at least one of the required attributes.'))
+		else:
+			results.append((index, item, None))
+	return results
+
+# Walks every entity matched by query with cursors, holding one page at a time
+def iter_entities(query, page_size=EXPORT_PAGE_SIZE):
+	cursor = None
+	while True:
+		l_iterator = query.fetch(limit = page_size, start_cursor = cursor)
+		page = list(next(l_iterator.pages))
+		for entity in page:
+			yield entity
+		# A short page does not mean the end; only a missing cursor does
+		cursor = l_iterator.next_page_token
+		if not cursor:
+			return
+
+# Streams the entities matched by query as newline-delimited JSON, one
+# page in memory at a time. format_entity(entity), if given, returns the
+# object written for each entity; otherwise the entity is written with its id.
+def ndjson_response(query, format_entity=None):
+	def generate():
+		for entity in iter_entities(query):
+			if format_entity:
+				entity = format_entity(entity)
+			else:
+				entity['id'] = entity.key.id_or_name
+			yield dumps_bytes(entity) + b'\n'
+	return Response(generate(), 200, mimetype='application/x-ndjson')
+
+# Contention counters for run_in_transaction
+_txn_lock = threading.Lock()
+_txn_stats = {'transactions': 0, 'retries': 0, 'failures': 0}
+
+def _count_txn(name):
+	with _txn_lock:
+		_txn_stats[name] += 1
+
+def transaction_stats():
+	with _txn_lock:
+		return dict(_txn_stats)
+
+@register_collector
+def _transaction_metrics():
+	stats = transaction_stats()
+	return [
+		('datastore_transactions_total', 'counter', 'Transactions started by run_in_transaction.', stats['transactions']),
+		('datastore_transaction_retries_total', 'counter', 'Transactions retried after contention.', stats['retries']),
+		('datastore_transaction_failures_total', 'counter', 'Transactions that still conflicted after every retry.', stats['failures']),
+	]
+
+# Runs fn() inside a transaction and returns its result. fn must do its
+# reads inside the transaction; when the commit is aborted by a concurrent
+# write the whole function is re-run on fresh data after a backoff.
+def run_in_transaction(client, fn):
+	_count_txn('transactions')
+	for attempt in range(TXN_RETRIES + 1):
+		try:
+			with client.transaction():
+				return fn()
+		except api_exceptions.Conflict:
+			if attempt == TXN_RETRIES:
+				_count_txn('failures')
+				raise AuthError({'Error': 'The request conflicted with concurrent updates. Please retry.'}, 409)
+			_count_txn('retries')
+			time.sleep(random.uniform(0, min(TXN_MAX_BACKOFF, TXN_BACKOFF * 2 ** attempt)))
+
+# Applies update(entity) to every existing entity in keys and writes them
+# back with get_multi/put_multi, one transaction per TXN_ENTITY_GROUPS keys.
+# finish(), if given, runs inside the last transaction so the final write
+# (e.g. deleting the parent entity) commits together with the last chunk;
+# that chunk leaves room for the finish_groups entity groups finish touches.
+def update_in_transactions(client, keys, update, finish=None, finish_groups=0):
+	chunks = [keys[start:start + TXN_ENTITY_GROUPS] for start in range(0, len(keys), TXN_ENTITY_GROUPS)] or [[]]
+	room = TXN_ENTITY_GROUPS - finish_groups if finish else TXN_ENTITY_GROUPS
+	if len(chunks[-1]) > room:
+		last = chunks.pop()
+		chunks.extend([last[:len(last) - room], last[len(last) - room:]])
+	for index, chunk in enumerate(chunks):
+		def apply_chunk():
+			entities = [e for e in get_multi_ordered(client, chunk) if e is not None]
+			for entity in entities:
+				update(entity)
+			if entities:
+				client.put_multi(entities)
+			if finish and index == len(chunks) - 1:
+				finish()
+		run_in_transaction(client, apply_chunk)
+
+# True when a fan-out over count entities should not block the request
+def fanout_is_async(count):
+	return FANOUT_ASYNC_THRESHOLD is not None and count > FANOUT_ASYNC_THRESHOLD
+
+_background = ThreadPoolExecutor(max_workers=2)
+
+def _log_failure(future):
+	if future.exception() is not None:
+		logging.error('Background task failed', exc_info=future.exception())
+
+# Runs fn(*args) off the request thread, logging any failure
+def run_in_background(fn, *args):
+	future = _background.submit(fn, *args)
+	future.add_done_callback(_log_failure)
+	return future
+
+# Process-wide JWKS cache, indexed by kid. The lock only guards these
+# values; fetches run outside it, one at a time through _jwks_flight.
+_jwks_lock = threading.Lock()
+_jwks_keys = {}
+_jwks_fetched_at = 0.0
+_jwks_attempted_at = 0.0
+_jwks_flight = group('jwks')
+
+def _jwks_url():
+	return JWKS_URL or "https://"+ auth0_config()['domain']+"/.well-known/jwks.json"
+
+def _fetch_jwks():
+	start = time.perf_counter()
+	try:
+		jsonurl = urlopen(_jwks_url(), timeout=JWKS_FETCH_TIMEOUT)
+		jwks = json.loads(jsonurl.read())
+	finally:
+		record_jwks_fetch(time.perf_counter() - start)
+	keys = {}
+	for key in jwks["keys"]:
+		keys[key["kid"]] = {
+			"kty": key["kty"],
+			"kid": key["kid"],
+			"use": key["use"],
+			"n": key["n"],
+			"e": key["e"]
+		}
+	return keys
+
+# Refetches the key set. The attempt is recorded first, so whether it
+# succeeds or not no other refetch starts for JWKS_MIN_REFRESH seconds and
+# the current (possibly stale) keys keep being served meanwhile.
+def _refresh_jwks():
+	global _jwks_keys, _jwks_fetched_at, _jwks_attempted_at
+	with _jwks_lock:
+		_jwks_attempted_at = time.monotonic()
+	try:
+		keys = _fetch_jwks()
+	except Exception:
+		logging.warning('JWKS fetch failed; serving cached keys', exc_info=True)
+		return
+	with _jwks_lock:
+		_jwks_keys = keys
+		_jwks_fetched_at = time.monotonic()
+
+def _refresh_jwks_once():
+	_jwks_flight.do('jwks', _refresh_jwks)
+
+# Returns the RSA key for kid, refreshing the cache on TTL expiry or kid
+# miss at most once per JWKS_MIN_REFRESH window
+def get_signing_key(kid):
+	with _jwks_lock:
+		now = time.monotonic()
+		throttled = now - _jwks_attempted_at <= JWKS_MIN_REFRESH
+		missing = not _jwks_keys or kid not in _jwks_keys
+		expired = now - _jwks_fetched_at > JWKS_TTL
+		refresh_ahead = now - _jwks_fetched_at > JWKS_TTL - JWKS_REFRESH_AHEAD
+
+	if not throttled:
+		if missing or expired:
+			_refresh_jwks_once()
+		elif refresh_ahead:
+			run_in_background(_refresh_jwks_once)
+	elif missing:
+		# A fetch started by another request may bring the key
+		_jwks_flight.wait('jwks')
+
+	with _jwks_lock:
+		if not _jwks_keys:
+			raise AuthError({"code": "jwks_unavailable",
+							"description":
+								"Unable to fetch signing keys"}, 503)
+		return _jwks_keys.get(kid, {})
+
+# Empties the JWKS cache so the next lookup refetches
+def clear_jwks_cache():
+	global _jwks_keys, _jwks_fetched_at, _jwks_attempted_at
+	with _jwks_lock:
+		_jwks_keys = {}
+		_jwks_fetched_at = 0.0
+		_jwks_attempted_at = 0.0
+
+# LRU of verified payloads keyed by token digest: digest -> (payload, expires_at)
+_token_lock = threading.Lock()
+_token_cache = OrderedDict()
+_token_stats = {'hits': 0, 'misses': 0}
+
+def _token_digest(token):
+	return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def _cached_payload(digest):
+	with _token_lock:
+		entry = _token_cache.get(digest)
+		if entry is None:
+			_token_stats['misses'] += 1
+			return None
+		payload, expires_at = entry
+		if expires_at <= time.time():
+			# Drop it and let the full decode raise token_expired
+			del _token_cache[digest]
+			_token_stats['misses'] += 1
+			return None
+		_token_cache.move_to_end(digest)
+		_token_stats['hits'] += 1
+		return payload
+
+def _cache_payload(digest, payload):
+	expires_at = time.time() + TOKEN_CACHE_MAX_AGE
+	if isinstance(payload.get('exp'), (int, float)):
+		expires_at = min(expires_at, payload['exp'])
+	with _token_lock:
+		_token_cache[digest] = (payload, expires_at)
+		_token_cache.move_to_end(digest)
+		while len(_token_cache) > TOKEN_CACHE_SIZE:
+			_token_cache.popitem(last=False)
+
+# Returns hit/miss counters and current size of the verified-token cache
+def token_cache_stats():
+	with _token_lock:
+		stats = dict(_token_stats)
+		stats['size'] = len(_token_cache)
+	return stats
+
+@register_collector
+def _token_cache_metrics():
+	stats = token_cache_stats()
+	return [
+		('token_cache_hits_total', 'counter', 'Bearer tokens served from the verified-token cache.', stats['hits']),
+		('token_cache_misses_total', 'counter', 'Bearer tokens that needed a full RS256 verification.', stats['misses']),
+		('token_cache_entries', 'gauge', 'Verified tokens currently cached.', stats['size']),
+	]
+
+def clear_token_cache():
+	with _token_lock:
+		_token_cache.clear()
+		_token_stats['hits'] = 0
+		_token_stats['misses'] = 0
+
 # Verifies JWT is authentic and valid
 def verify_jwt(request):
 	if 'Authorization' not in request.headers:
@@ -41,8 +543,12 @@ def verify_jwt(request):
 	auth_header = request.headers['Authorization'].split();
 	token = auth_header[1]
 
-	jsonurl = urlopen("https://"+ DOMAIN+"/.well-known/jwks.json")
-	jwks = json.loads(jsonurl.read())
+	# Tokens verified earlier skip the header parse and RSA signature check
+	digest = _token_digest(token)
+	payload = _cached_payload(digest)
+	if payload is not None:
+		return payload
+
 	try:
 		unverified_header = jwt.get_unverified_header(token)
 	except jwt.JWTError:
@@ -55,24 +561,15 @@ def verify_jwt(request):
 						"description":
 							"Invalid header. "
 							"Use an RS256 signed JWT Access Token"}, 401)
-	rsa_key = {}
-	for key in jwks["keys"]:
-		if key["kid"] == unverified_header["kid"]:
-			rsa_key = {
-				"kty": key["kty"],
-				"kid": key["kid"],
-				"use": key["use"],
-				"n": key["n"],
-				"e": key["e"]
-			}
+	rsa_key = get_signing_key(unverified_header.get("kid"))
 	if rsa_key:
 		try:
 			payload = jwt.decode(
 				token,
 				rsa_key,
 				algorithms=ALGORITHMS,
-				audience=CLIENT_ID,
-				issuer="https://"+ DOMAIN+"/"
+				audience=auth0_config()['client_id'],
+				issuer="https://"+ auth0_config()['domain']+"/"
 			)
 		except jwt.ExpiredSignatureError:
 			raise AuthError({"code": "token_expired",
@@ -88,6 +585,7 @@ def verify_jwt(request):
 								"Unable to parse authentication"
 								" token."}, 401)
 
+		_cache_payload(digest, payload)
 		return payload
 	else:
 		raise AuthError({"code": "no_rsa_key",
@@ -0,0 +1,179 @@
+"""
+Maintenance jobs for the Datastore entities used by the backend.
+
+Run from this directory with the same credentials as the app, e.g.
+	python jobs.py migrate_users
+	python jobs.py repair_milestone_summaries [milestone_id]
+	python jobs.py migrate_assignments
+	python jobs.py backfill_milestone_ages
+	python jobs.py rebuild_progress
+"""
+import sys
+
+from google.cloud import datastore
+from six.moves.urllib.parse import quote
+
+from config import client
+from helpers import update_in_transactions, put_multi_chunked, delete_multi_chunked, touch
+from assignments import milestone_summary, assignment_key, build_assignment, milestone_assignments_query
+from milestones import parse_age
+from progress import adjust_child_progress, adjust_totals
+
+
+# Datastore accepts at most 500 entities per put_multi/delete_multi call
+BATCH_SIZE = 500
+
+def _chunks(items, size=BATCH_SIZE):
+	for start in range(0, len(items), size):
+		yield items[start:start + size]
+
+# Re-keys users created with numeric ids onto their Auth0 sub so logins and
+# ownership checks can use a single client.get. Duplicate rows for the same
+# sub are merged.
+def migrate_users(base_url='https://cs493finalproject.wm.r.appspot.com/'):
+	migrated = {}
+	old_keys = []
+
+	for user in client.query(kind='users').fetch():
+		if user.key.name is not None:
+			continue
+		old_keys.append(user.key)
+
+		sub = user['user_id']
+		if sub not in migrated:
+			existing = client.get(key=client.key('users', sub))
+			if existing is None:
+				existing = datastore.Entity(key=client.key('users', sub))
+				existing.update(user)
+				existing['children'] = []
+				existing['checkmarked'] = []
+			migrated[sub] = existing
+		new_user = migrated[sub]
+
+		# Merge reference lists without duplicating entries
+		for field in ('children', 'checkmarked'):
+			for element in user.get(field, []):
+				if element not in new_user[field]:
+					new_user[field].append(element)
+		new_user['self'] = base_url + 'users/' + quote(sub, safe='')
+
+	for batch in _chunks(list(migrated.values())):
+		client.put_multi(batch)
+	for batch in _chunks(old_keys):
+		client.delete_multi(batch)
+
+	print('Migrated %d users from %d numeric-keyed entities' % (len(migrated), len(old_keys)))
+
+# Rewrites the milestone summaries copied into assignments and children's
+# milestones_assigned from the current milestone entities. Pass a milestone
+# id to repair only that milestone, e.g. after its text was edited. An edit
+# can move a milestone to another (category, age) bucket, so the progress
+# counters are rebuilt afterwards.
+def repair_milestone_summaries(milestone_id=None):
+	if milestone_id is not None:
+		milestones = [client.get(key=client.key('milestones', int(milestone_id)))]
+	else:
+		milestones = list(client.query(kind='milestones').fetch())
+
+	repaired = 0
+	for single_milestone in milestones:
+		if single_milestone is None:
+			continue
+		summary = milestone_summary(single_milestone.key.id, single_milestone)
+
+		def refresh(single_child):
+			single_child['milestones_assigned'] = [summary if e['id'] == summary['id'] else e for e in single_child['milestones_assigned']]
+			touch(single_child)
+			assignment = client.get(key=assignment_key(single_child.key.id, summary['id']))
+			if assignment is not None:
+				assignment.update(summary)
+				client.put(assignment)
+
+		child_keys = [e.key.parent for e in milestone_assignments_query(single_milestone.key.id, keys_only=True).fetch()]
+		update_in_transactions(client, child_keys, refresh)
+		repaired += len(child_keys)
+
+	print('Refreshed summaries on %d child references' % repaired)
+	rebuild_progress()
+
+# Moves child-milestone links from the old list properties into the
+# assignments join kind, and drops milestones' children_id_assigned lists
+def migrate_assignments():
+	milestones = dict((m.key.id, m) for m in client.query(kind='milestones').fetch())
+
+	created = 0
+	for single_child in client.query(kind='children').fetch():
+		assignments = []
+		for element in single_child.get('milestones_assigned', []):
+			single_milestone = milestones.get(int(element['id']))
+			if single_milestone is not None:
+				assignments.append(build_assignment(single_child, element['id'], single_milestone))
+		put_multi_chunked(client, assignments)
+		created += len(assignments)
+
+	changed = []
+	for single_milestone in milestones.values():
+		if 'children_id_assigned' in single_milestone:
+			del single_milestone['children_id_assigned']
+			changed.append(touch(single_milestone))
+	put_multi_chunked(client, changed)
+
+	print('Created %d assignments; cleaned %d milestones' % (created, len(changed)))
+
+# Stores the numeric age_min_months/age_max_months parsed from each
+# milestone's age text, so milestones created before age filtering show up
+# in ?min_age=/?max_age=/?sort=age queries
+def backfill_milestone_ages():
+	changed = []
+	for single_milestone in client.query(kind='milestones').fetch():
+		age_min, age_max = parse_age(single_milestone.get('age'))
+		if single_milestone.get('age_min_months', False) != age_min or single_milestone.get('age_max_months', False) != age_max:
+			single_milestone['age_min_months'] = age_min
+			single_milestone['age_max_months'] = age_max
+			changed.append(touch(single_milestone))
+	put_multi_chunked(client, changed)
+
+	print('Backfilled ages on %d milestones' % len(changed))
+
+# Recomputes the progress counters from scratch: the milestone_totals
+# shards from the milestones kind, and every child's done counts from its
+# milestones_assigned. Legacy {id, self} entries carry no category or age,
+# so they are counted from the milestone they point at. Writes racing with the job can leave a counter off
+# by their own change, so run it while traffic is quiet.
+def rebuild_progress():
+	old_totals = client.query(kind='milestone_totals')
+	old_totals.keys_only()
+	delete_multi_chunked(client, [e.key for e in old_totals.fetch()])
+	milestones = list(client.query(kind='milestones').fetch())
+	adjust_totals(milestones, 1)
+	by_id = dict((m.key.id, m) for m in milestones)
+
+	def recount(single_child):
+		single_child['progress'] = []
+		for entry in single_child['milestones_assigned']:
+			if 'category' not in entry:
+				entry = by_id.get(entry['id'])
+				if entry is None:
+					continue
+			adjust_child_progress(single_child, entry, 1)
+		touch(single_child)
+
+	children = client.query(kind='children')
+	children.keys_only()
+	child_keys = [e.key for e in children.fetch()]
+	update_in_transactions(client, child_keys, recount)
+
+	print('Rebuilt totals for %d milestones and progress for %d children' % (len(milestones), len(child_keys)))
+
+JOBS = {
+	'migrate_users': migrate_users,
+	'repair_milestone_summaries': repair_milestone_summaries,
+	'migrate_assignments': migrate_assignments,
+	'backfill_milestone_ages': backfill_milestone_ages,
+	'rebuild_progress': rebuild_progress,
+}
+
+if __name__ == '__main__':
+	if len(sys.argv) < 2 or sys.argv[1] not in JOBS:
+		sys.exit('Usage: python jobs.py {%s} [args...]' % ','.join(sorted(JOBS)))
+	JOBS[sys.argv[1]](*sys.argv[2:])
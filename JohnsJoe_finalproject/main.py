@@ -8,26 +8,23 @@ to access these entities with authentication provided by OAuth.
 """
 from flask import Flask, Blueprint, render_template, request, session, redirect, url_for
 from google.cloud import datastore
-import os
 import json
+import threading
 from functools import wraps
 from authlib.integrations.flask_client import OAuth
-from six.moves.urllib.parse import urlencode
+from jose import jwt
+from six.moves.urllib.parse import urlencode, quote
 
 import milestones
 import children
 import helpers
+import metrics
+import sessions
+import tasks
+from helpers import json_response, fetch_page, ndjson_response, get_shared
+from config import auth0_config, client, secret_key
 
-app = Flask(__name__)
-app.register_blueprint(milestones.bp)
-app.register_blueprint(children.bp)
-app.register_blueprint(helpers.bp)
-
-client = datastore.Client()
-
-# Open secret client data 
-with open('osu.us.auth0.json') as f:
-	json_file = json.load(f)
+bp = Blueprint('auth', __name__)
 
 # Set CALLBACK_URL based on host location
 if __name__ == '__main__':
@@ -36,32 +33,52 @@ else:
 	CALLBACK_URL = 'https://cs493finalproject.wm.r.appspot.com/callback'
 
 ALGORITHMS = ["RS256"]
-CLIENT_ID = json_file['client_id']
-CLIENT_SECRET = json_file['client_secret']
-DOMAIN = json_file['domain']
-
-# Set secret_key to access Session data
-app.secret_key = os.urandom(16)
-
-# Oauth 
-oauth = OAuth(app)
-
-auth0 = oauth.register(
-    'auth0',
-    client_id=CLIENT_ID,
-    client_secret=CLIENT_SECRET,
-    api_base_url="https://" + DOMAIN,
-    access_token_url="https://" + DOMAIN + "/oauth/token",
-    authorize_url="https://" + DOMAIN + "/authorize",
-    client_kwargs={
-        'scope': 'openid profile email',
-    },
-)
+
+# Oauth, registered with Auth0 on the first login rather than at startup
+oauth = OAuth()
+_auth0_lock = threading.Lock()
+
+def get_auth0():
+	with _auth0_lock:
+		auth0 = oauth.create_client('auth0')
+		if auth0 is None:
+			json_file = auth0_config()
+			auth0 = oauth.register(
+				'auth0',
+				client_id=json_file['client_id'],
+				client_secret=json_file['client_secret'],
+				api_base_url="https://" + json_file['domain'],
+				access_token_url="https://" + json_file['domain'] + "/oauth/token",
+				authorize_url="https://" + json_file['domain'] + "/authorize",
+				client_kwargs={
+					'scope': 'openid profile email',
+				},
+			)
+		return auth0
+
+def create_app():
+	app = Flask(__name__)
+	app.register_blueprint(bp)
+	app.register_blueprint(milestones.bp)
+	app.register_blueprint(milestones.bulk_bp)
+	app.register_blueprint(children.bp)
+	app.register_blueprint(children.bulk_bp)
+	app.register_blueprint(helpers.bp)
+	app.register_blueprint(metrics.bp)
+	app.register_blueprint(tasks.bp)
+
+	# Session cookies are signed with a key that is stable across
+	# instances and restarts
+	app.secret_key = secret_key()
+	app.session_interface = sessions.session_interface
+
+	oauth.init_app(app)
+	return app
 
 def requires_auth(f):
   @wraps(f)
   def decorated(*args, **kwargs):
-    if 'profile' not in session:
+    if 'user_id' not in session:
       # Redirect to Login page here
       return redirect('/')
     return f(*args, **kwargs)
@@ -69,84 +86,119 @@ def requires_auth(f):
   return decorated
 	
 # Send user to home page
-@app.route('/')
+@bp.route('/')
 def home():
 	return render_template('home.html')
 	
 # Login logic
-@app.route('/login')
+@bp.route('/login')
 def login():
-	return auth0.authorize_redirect(redirect_uri=CALLBACK_URL)
+	return get_auth0().authorize_redirect(redirect_uri=CALLBACK_URL)
 
 # Logout logic
-@app.route('/logout')
+@bp.route('/logout')
 def logout():
     # Clear session stored data
     session.clear()
     # Redirect user to logout endpoint
-    params = {'returnTo': url_for('home', _external=True), 'client_id': CLIENT_ID}
-    return redirect(auth0.api_base_url + '/v2/logout?' + urlencode(params))
+    params = {'returnTo': url_for('auth.home', _external=True), 'client_id': auth0_config()['client_id']}
+    return redirect(get_auth0().api_base_url + '/v2/logout?' + urlencode(params))
 	
 # Displays information for user credentials
-@app.route('/dashboard')
+@bp.route('/dashboard')
 @requires_auth
 def dashboard():
+	# The session holds only the user key; the profile is the user entity.
+	# The token is shown once, on the page the login callback renders.
+	single_user = get_shared(client, client.key('users', session['user_id']))
+	if single_user is None:
+		session.clear()
+		return redirect('/')
+	profile = dict((field, single_user[field]) for field in user_summary_fields)
 	return render_template('dashboard.html',
-						   userinfo=session['profile'],
-						   userinfo_pretty=json.dumps(session['jwt_payload'], indent=4),
-						   token=session['token'] )
+						   userinfo=profile,
+						   userinfo_pretty=json.dumps(profile, indent=4),
+						   token=None )
 
 # Here we're using the /callback route.
-@app.route('/callback')
+@bp.route('/callback')
 def callback_handling():
 	# Handles response from token endpoint
+	auth0 = get_auth0()
 	id_token = auth0.authorize_access_token()["id_token"]
 	resp = auth0.get('userinfo')
 	userinfo = resp.json()
 
-	# Store the user information in flask session.
-	session['token'] = id_token
-	session['jwt_payload'] = userinfo
-	session['profile'] = {
-		'user_id': userinfo['sub'],
-		'name': userinfo['name'],
-		'picture': userinfo['picture']
-	}
+	# Store only the user key in a fresh session
+	sessions.start_session(session, userinfo['sub'])
 	
 	# Add new users to "users" entity in DataStore if not already present
-	# Get current list of users
-	query = client.query(kind='users')
-	all_users = list(query.fetch())
-	check_list = next((user for user in all_users if user['user_id'] == userinfo['sub']), None)
+	# Users are keyed by their Auth0 sub, so this is a single lookup
+	user_key = client.key('users', userinfo['sub'])
+	single_user = get_shared(client, user_key)
 	
-	# If not in list, add to DataStore entity
-	if not check_list:
-		new_user = datastore.Entity(key=client.key('users'))
+	# If not present, add to DataStore entity
+	if not single_user:
+		new_user = datastore.Entity(key=user_key)
 		new_user.update({
 			'user_id': userinfo['sub'],
 			'name': userinfo['name'],
 			'picture': userinfo['picture'],
 			'checkmarked': [],
-			'children': []
+			'children': [],
+			'self': request.url_root + 'users/' + quote(userinfo['sub'], safe='')
 		})
 		client.put(new_user)
-		
-		# Update with self url and return with id
-		new_user.update({
-			'self': request.base_url + '/' + str(new_user.key.id)
-		})
-		client.put(new_user)
-		
-	return redirect('/dashboard')
+	
+	# Show the token now rather than keeping it in the session
+	return render_template('dashboard.html',
+						   userinfo=userinfo,
+						   userinfo_pretty=json.dumps(jwt.get_unverified_claims(id_token), indent=4),
+						   token=id_token )
+
+# Fields listed by GET /users, read with a projection query so the users'
+# children and checkmarked lists are never loaded
+user_summary_fields = ['user_id', 'name', 'picture']
+
+# Formats a projected user entity for GET /users
+def format_user(single_user, url_root):
+	return {
+		'id': single_user.key.name,
+		'user_id': single_user['user_id'],
+		'name': single_user['name'],
+		'picture': single_user['picture'],
+		'self': url_root + 'users/' + quote(single_user.key.name, safe='')
+	}
 
 # Method for getting all users for a specific user
-@app.route('/users', methods = ['GET'])
+@bp.route('/users', methods = ['GET'])
 def users_get():
 	if request.method == 'GET':
+		# Served by the (user_id, name, picture) index
 		query = client.query(kind='users')
-		all_users = list(query.fetch())
+		query.projection = user_summary_fields
+		query.order = ['user_id']
+		url_root = request.url_root
+		
+		# Every user, streamed a page at a time as newline-delimited JSON
+		if request.accept_mimetypes.best == 'application/x-ndjson':
+			return ndjson_response(query, lambda e: format_user(e, url_root))
+		
+		# Get one page of users and the cursor for the next one
+		all_users, next_url, next_token = fetch_page(query, request)
+		
+		all_users_formatted = {
+			"users": [format_user(e, url_root) for e in all_users]
+		}
+		
+		# Set next_url if is not None
+		if next_url:
+			all_users_formatted['next'] = next_url
+			all_users_formatted['next_page_token'] = next_token
+
+		return json_response(all_users_formatted)
 
-		return json.dumps(all_users), 200, {'Content-Type':'application/json'} 
+app = create_app()
 
 if __name__ == '__main__':
 	app.run(host='127.0.0.1', port=8080, debug=True)
\ No newline at end of file
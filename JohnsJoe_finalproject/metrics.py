@@ -0,0 +1,185 @@
+# Per-request latency instrumentation and Datastore call accounting
+#
+# Every request gets a Server-Timing header with its total time, Datastore
+# time and call counts, and JWKS fetch time. Process-wide totals are served
+# in Prometheus text format at /metrics. Requests slower than
+# SLOW_REQUEST_MS are logged as one JSON line each.
+import json
+import logging
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import Blueprint, Response, g, has_app_context, request
+
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', '500'))
+
+# Histogram buckets for request latency, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Datastore RPCs counted as calls, and the op name they count as
+DATASTORE_OPS = {
+	'lookup': 'lookup',
+	'run_query': 'query',
+	'begin_transaction': 'begin',
+	'commit': 'commit',
+	'rollback': 'rollback',
+	'allocate_ids': 'allocate',
+}
+
+bp = Blueprint('metrics', __name__)
+
+slow_log = logging.getLogger('slow_requests')
+
+_lock = threading.Lock()
+_routes = {}
+_datastore = {}
+_datastore_by_route = {}
+_jwks = {'count': 0, 'seconds': 0.0}
+_collectors = []
+
+# Registers fn() -> [(name, type, help, value)] to be included in /metrics
+def register_collector(fn):
+	_collectors.append(fn)
+	return fn
+
+def _request_stats():
+	if not has_app_context():
+		return None
+	if 'request_stats' not in g:
+		g.request_stats = {'datastore': {}, 'datastore_seconds': 0.0, 'jwks_seconds': 0.0}
+	return g.request_stats
+
+def record_datastore(op, seconds):
+	with _lock:
+		total = _datastore.setdefault(op, {'count': 0, 'seconds': 0.0})
+		total['count'] += 1
+		total['seconds'] += seconds
+	stats = _request_stats()
+	if stats is not None:
+		stats['datastore'][op] = stats['datastore'].get(op, 0) + 1
+		stats['datastore_seconds'] += seconds
+
+def record_jwks_fetch(seconds):
+	with _lock:
+		_jwks['count'] += 1
+		_jwks['seconds'] += seconds
+	stats = _request_stats()
+	if stats is not None:
+		stats['jwks_seconds'] += seconds
+
+def _timed(op, fn):
+	@wraps(fn)
+	def wrapper(*args, **kwargs):
+		start = time.perf_counter()
+		try:
+			return fn(*args, **kwargs)
+		finally:
+			record_datastore(op, time.perf_counter() - start)
+	return wrapper
+
+# Wraps the RPCs on the client's underlying API object so every call that
+# reaches Datastore is counted and timed. Writes inside a transaction are
+# only buffered by put/delete and go out with its commit, so they are
+# timed there rather than as separate calls.
+def instrument_client(client):
+	api = client._datastore_api
+	for method, op in DATASTORE_OPS.items():
+		setattr(api, method, _timed(op, getattr(api, method)))
+	return client
+
+@bp.before_app_request
+def start_timer():
+	g.request_start = time.perf_counter()
+	_request_stats()
+
+@bp.after_app_request
+def record_request(response):
+	if 'request_start' not in g:
+		return response
+	elapsed = time.perf_counter() - g.request_start
+	stats = _request_stats()
+	route = request.url_rule.rule if request.url_rule else 'unmatched'
+	key = (route, request.method, str(response.status_code))
+
+	with _lock:
+		histogram = _routes.setdefault(key, {'buckets': [0] * len(LATENCY_BUCKETS), 'count': 0, 'sum': 0.0})
+		for index, bound in enumerate(LATENCY_BUCKETS):
+			if elapsed <= bound:
+				histogram['buckets'][index] += 1
+		histogram['count'] += 1
+		histogram['sum'] += elapsed
+		for op, count in stats['datastore'].items():
+			by_route = (route, request.method, op)
+			_datastore_by_route[by_route] = _datastore_by_route.get(by_route, 0) + count
+
+	calls = ' '.join('%s=%d' % (op, count) for op, count in sorted(stats['datastore'].items()))
+	timings = [
+		'app;dur=%.2f' % (elapsed * 1000),
+		'datastore;dur=%.2f;desc="%s"' % (stats['datastore_seconds'] * 1000, calls),
+	]
+	if stats['jwks_seconds']:
+		timings.append('jwks;dur=%.2f' % (stats['jwks_seconds'] * 1000))
+	response.headers['Server-Timing'] = ', '.join(timings)
+
+	if elapsed * 1000 >= SLOW_REQUEST_MS:
+		slow_log.warning(json.dumps({
+			'event': 'slow_request',
+			'method': request.method,
+			'route': route,
+			'path': request.path,
+			'status': response.status_code,
+			'duration_ms': round(elapsed * 1000, 2),
+			'datastore_ms': round(stats['datastore_seconds'] * 1000, 2),
+			'datastore_calls': stats['datastore'],
+			'jwks_ms': round(stats['jwks_seconds'] * 1000, 2)
+		}))
+	return response
+
+def _labels(**labels):
+	return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels.items()) + '}'
+
+# Renders all metrics in the Prometheus text exposition format
+def render():
+	lines = []
+	with _lock:
+		lines.append('# HELP http_request_duration_seconds Request latency by route.')
+		lines.append('# TYPE http_request_duration_seconds histogram')
+		for (route, method, status), histogram in sorted(_routes.items()):
+			for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+				lines.append('http_request_duration_seconds_bucket%s %d' % (_labels(route=route, method=method, status=status, le=bound), count))
+			lines.append('http_request_duration_seconds_bucket%s %d' % (_labels(route=route, method=method, status=status, le='+Inf'), histogram['count']))
+			lines.append('http_request_duration_seconds_sum%s %f' % (_labels(route=route, method=method, status=status), histogram['sum']))
+			lines.append('http_request_duration_seconds_count%s %d' % (_labels(route=route, method=method, status=status), histogram['count']))
+
+		lines.append('# HELP datastore_calls_total Datastore calls by operation.')
+		lines.append('# TYPE datastore_calls_total counter')
+		for op, total in sorted(_datastore.items()):
+			lines.append('datastore_calls_total%s %d' % (_labels(op=op), total['count']))
+		lines.append('# HELP datastore_call_duration_seconds_total Time spent in Datastore calls by operation.')
+		lines.append('# TYPE datastore_call_duration_seconds_total counter')
+		for op, total in sorted(_datastore.items()):
+			lines.append('datastore_call_duration_seconds_total%s %f' % (_labels(op=op), total['seconds']))
+		lines.append('# HELP datastore_route_calls_total Datastore calls made while serving each route.')
+		lines.append('# TYPE datastore_route_calls_total counter')
+		for (route, method, op), count in sorted(_datastore_by_route.items()):
+			lines.append('datastore_route_calls_total%s %d' % (_labels(route=route, method=method, op=op), count))
+
+		lines.append('# HELP jwks_fetches_total JWKS documents fetched from Auth0.')
+		lines.append('# TYPE jwks_fetches_total counter')
+		lines.append('jwks_fetches_total %d' % _jwks['count'])
+		lines.append('# HELP jwks_fetch_duration_seconds_total Time spent fetching JWKS documents.')
+		lines.append('# TYPE jwks_fetch_duration_seconds_total counter')
+		lines.append('jwks_fetch_duration_seconds_total %f' % _jwks['seconds'])
+
+	for collector in _collectors:
+		for name, metric_type, help_text, value in collector():
+			lines.append('# HELP %s %s' % (name, help_text))
+			lines.append('# TYPE %s %s' % (name, metric_type))
+			lines.append('%s %s' % (name, value))
+	return '\n'.join(lines) + '\n'
+
+@bp.route('/metrics', methods = ['GET'])
+def metrics_get():
+	return Response(render(), 200, mimetype='text/plain; version=0.0.4')
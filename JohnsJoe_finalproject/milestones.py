@@ -1,122 +1,344 @@
 # Routing functions for milestones 
 
+import re
+
 from flask import Blueprint, request
 from google.cloud import datastore
-import json
-
-from helpers import verify_content_type
 
-client = datastore.Client()
+from helpers import verify_jwt, verify_content_type, fetch_page, new_key, new_keys, get_shared, update_in_transactions, fanout_is_async
+from helpers import run_in_transaction, AuthError, TXN_ENTITY_GROUPS
+from helpers import validate_batch, ndjson_response, json_response
+from helpers import touch, entity_etag, list_etag, not_modified, cache_headers, CATALOG_CACHE_CONTROL, PRIVATE_CACHE_CONTROL
+from cache import milestone_cache, milestone_key, milestone_list_key, invalidate_milestones
+from assignments import milestone_assignments_query, assignment_key
+from progress import bucket, adjust_child_progress, adjust_totals_in_transaction
+from tasks import task, enqueue
+from config import client
 
 bp = Blueprint('milestones', __name__, url_prefix='/milestones')
 
+# Collection-level custom methods (/milestones:batch) sit beside the prefix
+bulk_bp = Blueprint('milestones_bulk', __name__)
+
+milestone_required_headers = ['activity', 'age', 'category', 'milestone']
+
+# Months per unit for the free-text age field ("0-1 month", "2 years")
+age_units = {'day': 1 / 30.0, 'week': 12 / 52.0, 'month': 1.0, 'year': 12.0}
+age_pattern = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*(?:(?:-|to)\s*(\d+(?:\.\d+)?))?\s*(day|week|month|year)s?\b', re.I)
+
+# Parses an age like "0-1 month" into (min, max) months as floats, so the
+# catalog can be filtered and sorted by age in Datastore. Unrecognized
+# ages, including ones that are not strings, give (None, None) and are
+# left out of age-filtered queries.
+def parse_age(age):
+	if not isinstance(age, str):
+		return None, None
+	match = age_pattern.match(age)
+	if not match:
+		return None, None
+	low, high, unit = match.groups()
+	factor = age_units[unit.lower()]
+	return round(float(low) * factor, 2), round(float(high or low) * factor, 2)
+
+# Builds a new milestone entity from a validated request body
+def build_milestone(key, body, base_url):
+	new_milestone = datastore.Entity(key=key)
+	age_min, age_max = parse_age(body['age'])
+	new_milestone.update({
+		'activity': body['activity'],
+		'age': body['age'],
+		'age_min_months': age_min,
+		'age_max_months': age_max,
+		'category': body['category'],
+		'milestone': body['milestone'],
+		'self': base_url + '/' + str(key.id),
+		'version': 1
+	})
+	return new_milestone
+
+# ?sort= values and the property order each maps to
+milestone_sort_orders = {
+	'age': ['age_min_months'],
+	'-age': ['-age_min_months'],
+	'category': ['category'],
+	'milestone': ['milestone'],
+}
+
+# Builds the catalog query from ?category=, ?min_age=/?max_age= (months,
+# matched against the age a milestone starts at) and ?sort=. Every
+# combination is served by a built-in or index.yaml index. Returns the
+# query, or None and an error message.
+def milestones_query(args):
+	query = client.query(kind='milestones')
+	
+	category = args.get('category')
+	if category:
+		query.add_filter('category', '=', category)
+	
+	try:
+		min_age = float(args['min_age']) if 'min_age' in args else None
+		max_age = float(args['max_age']) if 'max_age' in args else None
+	except ValueError:
+		return None, 'The min_age and max_age parameters must be numbers of months.'
+	if min_age is not None:
+		query.add_filter('age_min_months', '>=', min_age)
+	if max_age is not None:
+		query.add_filter('age_min_months', '<=', max_age)
+	
+	# Datastore sorts by the inequality property first, so age filters
+	# only combine with an age sort
+	sort = args.get('sort', 'age' if min_age is not None or max_age is not None else None)
+	if sort is None:
+		return query, None
+	if sort not in milestone_sort_orders:
+		return None, 'The sort parameter must be one of: %s.' % ', '.join(sorted(milestone_sort_orders))
+	if (min_age is not None or max_age is not None) and sort not in ('age', '-age'):
+		return None, 'Age filters can only be combined with sort=age or sort=-age.'
+	if category and sort == 'category':
+		return query, None
+	query.order = milestone_sort_orders[sort]
+	return query, None
+
+# Ids of the caller's children a milestone is assigned to, from the
+# (milestone_id, user_id) assignments index. The catalog is public, so
+# callers without a valid token are anonymous and get none.
+def children_id_assigned(milestone_id):
+	if 'Authorization' not in request.headers:
+		return []
+	try:
+		payload = verify_jwt(request)
+	except AuthError:
+		return []
+	query = milestone_assignments_query(milestone_id, payload['sub'], keys_only=True)
+	return [e.key.parent.id for e in query.fetch()]
+
+# Update that removes a milestone from one child, batched and
+# transactional through update_in_transactions
+def remove_milestone(milestone_id):
+	def remove(single_child):
+		client.delete(assignment_key(single_child.key.id, milestone_id))
+		for entry in [e for e in single_child['milestones_assigned'] if e['id'] == int(milestone_id)]:
+			adjust_child_progress(single_child, entry, -1)
+		single_child['milestones_assigned'] = [e for e in single_child['milestones_assigned'] if e['id'] != int(milestone_id)]
+		touch(single_child)
+	return remove
+
+# Deletes a milestone and takes it off the catalog totals in the caller's
+# transaction; a milestone already gone is not subtracted twice
+def delete_milestone(datastore_key):
+	single_milestone = client.get(key=datastore_key)
+	if single_milestone is not None:
+		client.delete(datastore_key)
+		adjust_totals_in_transaction([single_milestone], -1)
+
+# Writes new milestones and adds them to the catalog totals in the caller's
+# transaction, so a failed commit leaves neither behind
+def create_milestones(new_milestones):
+	client.put_multi(new_milestones)
+	adjust_totals_in_transaction(new_milestones, 1)
+
+# Splits new milestones into groups that fit one transaction: each
+# milestone and each catalog total it changes is an entity group, and a
+# transaction holds at most TXN_ENTITY_GROUPS of them
+def transaction_chunks(new_milestones):
+	chunk, buckets = [], set()
+	for single_milestone in new_milestones:
+		added = 1 + (bucket(single_milestone) not in buckets)
+		if chunk and len(chunk) + len(buckets) + added > TXN_ENTITY_GROUPS:
+			yield chunk
+			chunk, buckets = [], set()
+		chunk.append(single_milestone)
+		buckets.add(bucket(single_milestone))
+	if chunk:
+		yield chunk
+
+# Removes a deleted milestone from every child still holding it; children
+# already cleaned up are no longer returned by the index, so reruns are safe
+@task('remove_milestone_from_children')
+def remove_milestone_from_children(payload):
+	milestone_id = payload['milestone_id']
+	child_keys = [e.key.parent for e in milestone_assignments_query(milestone_id, keys_only=True).fetch()]
+	update_in_transactions(client, child_keys, remove_milestone(milestone_id))
+
 # Routing function for getting and adding a milestone to the database
 @bp.route('', methods = ['GET', 'POST'])
 def milestones_get_post():
 	if request.method == 'GET':
 		verify_content_type(request)
-		query = client.query(kind='milestones')
-		
-		# Setting pagination 
-		q_limit = 5
-		q_offset = int(request.args.get('offset', '0'))
-		l_iterator = query.fetch(limit = q_limit, offset = q_offset)
-
-		# Get pages variable and list of milestones
-		pages = l_iterator.pages
-		all_milestones = list(next(pages))
 		
-		# If more milestones are on next page set next_url, else no more pages
-		if l_iterator.next_page_token:
-			next_offset = q_offset + q_limit
-			next_url = request.base_url + "?offset=" + str(next_offset)
-		else:
-			next_url = None
+		query, error = milestones_query(request.args)
+		if error:
+			return json_response({'Error': error}, 400)
 		
-		# Set id for each milestone
-		for e in all_milestones:
-			e["id"] = e.key.id
+		def load_page():
+			# Get one page of milestones and the cursor for the next one
+			all_milestones, next_url, next_token = fetch_page(query, request)
+			
+			# Set id for each milestone, as plain dicts so the page can be cached
+			all_milestones = [dict(e, id=e.key.id) for e in all_milestones]
+			
+			# Format milestones appropriately 
+			all_milestones_formatted = {
+				"milestones": all_milestones
+			}
+			
+			# Set next_url if is not None
+			if next_url:
+				all_milestones_formatted['next'] = next_url
+				all_milestones_formatted['next_page_token'] = next_token
+			
+			# Cache the page together with its ETag
+			return {
+				'body': all_milestones_formatted,
+				'etag': list_etag('milestones', all_milestones, next_token)
+			}
 		
-		# Format milestones appropriately 
-		all_milestones_formatted = {
-			"milestones": all_milestones
-		}
+		page_key = milestone_list_key(request.query_string.decode('utf-8'))
+		page = milestone_cache.get_or_load(page_key, load_page)
 		
-		# Set next_url if is not None
-		if next_url:
-			all_milestones_formatted['next'] = next_url
+		# Unchanged pages cost neither serialization nor a Datastore read
+		unchanged = not_modified(page['etag'], CATALOG_CACHE_CONTROL)
+		if unchanged:
+			return unchanged
 
-		return json.dumps(all_milestones_formatted), 200, {'Content-Type':'application/json'} 
+		return json_response(page['body'], 200, cache_headers(page['etag'], CATALOG_CACHE_CONTROL))
 	elif request.method == 'POST':
 		verify_content_type(request)
 		body = request.get_json()
-
-		milestone_required_headers = ['activity', 'age', 'category', 'milestone']
 		
 		if not set(milestone_required_headers).issubset(body.keys()):
-			return json.dumps({'Error': 'The request object is missing at least one of the required attributes.'}), 400, {'Content-Type':'application/json'}  
-		
-		# Set up entity and add to client
-		new_milestone = datastore.Entity(key=client.key('milestones'))
-		new_milestone.update({
-			'activity': body['activity'],
-			'age': body['age'],
-			'category': body['category'],
-			'milestone': body['milestone'],
-			'children_id_assigned': []
-		})
-		client.put(new_milestone)
-		
-		# Update with self url and return with id
-		new_milestone.update({
-			'self': request.base_url + '/' + str(new_milestone.key.id)
-		})
-		client.put(new_milestone)
+			return json_response({'Error': 'The request object is missing at least one of the required attributes.'}, 400)
+		
+		# Set up entity with a preallocated id and add to client
+		new_milestone = build_milestone(new_key(client, 'milestones'), body, request.base_url)
+		run_in_transaction(client, lambda: create_milestones([new_milestone]))
+		invalidate_milestones()
 		
 		new_milestone['id'] = new_milestone.key.id
+		new_milestone['children_id_assigned'] = []
 
-		return json.dumps(new_milestone), 201, {'Content-Type':'application/json'} 
+		return json_response(new_milestone, 201)
 	else:
-		return json.dumps({'Error': 'This API does not support this operation.'}), 405, {'Content-Type': 'application/json'}
+		return json_response({'Error': 'This API does not support this operation.'}, 405)
 
 # Methods for getting a single milestone or deleting a milestone from database
 @bp.route('/<milestone_id>', methods = ['GET', 'DELETE'])
 def milestones_get_delete_withid(milestone_id):
 	if request.method == 'GET':
 		verify_content_type(request)
-		milestone_key = client.key('milestones', int(milestone_id))
-		single_milestone = client.get(key=milestone_key)
+		
+		def load_milestone():
+			single_milestone = get_shared(client, client.key('milestones', int(milestone_id)))
+			return dict(single_milestone) if single_milestone else None
+		
+		single_milestone = milestone_cache.get_or_load(milestone_key(milestone_id), load_milestone)
 		
 		# Make sure milestone exists
 		if single_milestone == None:
-			return json.dumps({"Error": "No milestone with this milestone_id exists."}), 404, {'Content-Type':'application/json'} 
+			return json_response({"Error": "No milestone with this milestone_id exists."}, 404)
+		
+		# The cached milestone is shared; the caller's children are not
+		child_ids = children_id_assigned(milestone_id)
+		cache_control = PRIVATE_CACHE_CONTROL if 'Authorization' in request.headers else CATALOG_CACHE_CONTROL
+		etag = entity_etag('milestones', milestone_id, single_milestone, ''.join('-%d' % c for c in child_ids))
+		unchanged = not_modified(etag, cache_control)
+		if unchanged:
+			return unchanged
 		
-		# Add milestone id to json and return all
-		single_milestone['id'] = milestone_id
-		return json.dumps(single_milestone), 200, {'Content-Type':'application/json'} 
+		# Add milestone id to json and return all, leaving the cached copy untouched
+		single_milestone = dict(single_milestone, id=milestone_id, children_id_assigned=child_ids)
+		return json_response(single_milestone, 200, cache_headers(etag, cache_control))
 	elif request.method == 'DELETE':
 		verify_content_type(request)
 		
 		# Get requested milestone
-		milestone_key = client.key('milestones', int(milestone_id))
-		single_milestone = client.get(key=milestone_key)
+		datastore_key = client.key('milestones', int(milestone_id))
+		single_milestone = client.get(key=datastore_key)
 		
 		# Check if milestone exists
 		if not single_milestone:
-			return json.dumps({'Error': 'No milestone with this milestone_id exists.'}), 404, {'Content-Type':'application/json'}
+			return json_response({'Error': 'No milestone with this milestone_id exists.'}, 404)
 		
-		# Remove milestone from children
-		for child in single_milestone['children_id_assigned']:
-			child_key = client.key('children', child)
-			single_child = client.get(key=child_key)
-			
-			# Delete milestone from child
-			single_child['milestones_assigned'].remove({
-				'id': int(milestone_id),
-				'self': single_milestone['self']
-			})
-			
-			client.put(single_child)
+		# Children holding this milestone, from the assignments index
+		child_keys = [e.key.parent for e in milestone_assignments_query(milestone_id, keys_only=True).fetch()]
+		
+		# Large fan-outs: delete the milestone now and clean up children in a task
+		if fanout_is_async(len(child_keys)):
+			run_in_transaction(client, lambda: delete_milestone(datastore_key))
+			invalidate_milestones(milestone_id)
+			enqueue('remove_milestone_from_children', {'milestone_id': int(milestone_id)}, task_id='remove-milestone-' + str(milestone_id))
+			return json_response({}, 202)
 		
-		client.delete(milestone_key)
-		return {}, 204, {'Content-Type':'application/json'} 
\ No newline at end of file
+		# The last transaction also deletes the milestone and updates one totals shard
+		update_in_transactions(client, child_keys, remove_milestone(milestone_id), finish=lambda: delete_milestone(datastore_key), finish_groups=2)
+		invalidate_milestones(milestone_id)
+		
+		# An assignment committed after the query above is picked up here;
+		# none can be added once the milestone is gone
+		remove_milestone_from_children({'milestone_id': int(milestone_id)})
+		return json_response({}, 204)
+
+# Routing function for getting the caller's children a milestone is assigned to
+@bp.route('/<milestone_id>/children', methods = ['GET'])
+def milestones_get_children(milestone_id):
+	verify_content_type(request)
+	payload = verify_jwt(request)
+	
+	# Served by the (milestone_id, user_id) assignments index
+	query = milestone_assignments_query(milestone_id, payload['sub'])
+	assignments, next_url, next_token = fetch_page(query, request)
+	
+	all_children_formatted = {
+		"children": [{'id': e['child_id'], 'self': request.url_root + 'children/' + str(e['child_id'])} for e in assignments]
+	}
+	
+	# Set next_url if is not None
+	if next_url:
+		all_children_formatted['next'] = next_url
+		all_children_formatted['next_page_token'] = next_token
+	
+	return json_response(all_children_formatted)
+
+# Creates many milestones in one request, reporting a result per item
+@bulk_bp.route('/milestones:batch', methods = ['POST'])
+def milestones_batch():
+	verify_content_type(request)
+	items = validate_batch(request.get_json(), milestone_required_headers)
+	
+	valid = [(index, item) for index, item, error in items if error is None]
+	keys = new_keys(client, 'milestones', len(valid))
+	base_url = request.url_root + 'milestones'
+	new_milestones = [build_milestone(key, item, base_url) for key, (index, item) in zip(keys, valid)]
+	
+	# Each chunk commits or fails as a whole; items of a failed chunk get
+	# its error and can be resent without creating duplicates
+	failed = {}
+	for chunk in transaction_chunks(new_milestones):
+		try:
+			run_in_transaction(client, lambda: create_milestones(chunk))
+		except AuthError as error:
+			failed.update((single_milestone.key.id, error) for single_milestone in chunk)
+	invalidate_milestones()
+	
+	created = dict((index, milestone) for (index, item), milestone in zip(valid, new_milestones))
+	results = []
+	for index, item, error in items:
+		if error:
+			results.append({'index': index, 'status': 400, 'Error': error})
+		elif created[index].key.id in failed:
+			chunk_error = failed[created[index].key.id]
+			results.append({'index': index, 'status': chunk_error.status_code, 'Error': chunk_error.error['Error']})
+		else:
+			results.append({'index': index, 'status': 201, 'id': created[index].key.id, 'self': created[index]['self']})
+	
+	return json_response({'results': results})
+
+# Streams every milestone as newline-delimited JSON
+@bulk_bp.route('/milestones:export', methods = ['GET'])
+def milestones_export():
+	return ndjson_response(client.query(kind='milestones'))
+
+# Reports milestone cache hit ratio and cache vs Datastore latency
+@bulk_bp.route('/milestones:cache', methods = ['GET'])
+def milestones_cache_stats():
+	return json_response(milestone_cache.stats())
\ No newline at end of file
@@ -0,0 +1,117 @@
+# Precomputed counters behind GET /children/<id>/progress
+#
+# Progress is "done of total" per (category, age) bucket, where age is the
+# milestone's age text; the catalog is written in age bands ("0-1 month").
+# Neither side is computed from the catalog at read time:
+#	- totals live in the milestone_totals kind, keyed
+#	  '<category>|<age>|<shard>' and updated when milestones are created or
+#	  deleted. Each bucket is split over TOTAL_SHARDS entities so bulk
+#	  imports into one bucket do not all contend on a single counter.
+#	- done counts live on the child as a 'progress' list of
+#	  {category, age, done}, updated in the same transaction that writes
+#	  the child's milestones_assigned.
+# so a progress read is the child plus one query over the counters.
+# jobs.py rebuild_progress recomputes both from scratch.
+import random
+from collections import Counter
+
+from google.cloud import datastore
+
+from helpers import get_multi_ordered, run_in_transaction, TXN_ENTITY_GROUPS
+from config import client
+
+TOTAL_SHARDS = 4
+
+def bucket(single_milestone):
+	return single_milestone.get('category'), single_milestone.get('age')
+
+def total_key(category, age, shard):
+	return client.key('milestone_totals', '%s|%s|%d' % (category, age, shard))
+
+# Adds delta to a child's done count for the bucket of a milestone summary.
+# Call inside the transaction that writes the child.
+def adjust_child_progress(single_child, summary, delta):
+	category, age = bucket(summary)
+	if category is None or age is None:
+		return single_child
+	progress = [dict(e) for e in single_child.get('progress') or []]
+	for entry in progress:
+		if entry['category'] == category and entry['age'] == age:
+			entry['done'] += delta
+			break
+	else:
+		progress.append({'category': category, 'age': age, 'done': delta})
+	single_child['progress'] = [e for e in progress if e['done'] > 0]
+	return single_child
+
+# Adds delta * count to one random shard of each ((category, age), count)
+# bucket given. Call inside a transaction.
+def _apply_totals(buckets, ages, delta):
+	keys = [total_key(category, age, random.randrange(TOTAL_SHARDS)) for (category, age), count in buckets]
+	totals = []
+	for key, ((category, age), count), total in zip(keys, buckets, get_multi_ordered(client, keys)):
+		if total is None:
+			total = datastore.Entity(key=key)
+			total.update({'category': category, 'age': age, 'age_min_months': ages[(category, age)], 'count': 0})
+		total['count'] += delta * count
+		totals.append(total)
+	client.put_multi(totals)
+
+# Adds delta to the catalog totals for the milestones given, one random
+# shard per bucket. Call inside the transaction that writes or deletes
+# them; each distinct bucket is one more entity group in it.
+def adjust_totals_in_transaction(milestones, delta):
+	counts = Counter(bucket(m) for m in milestones)
+	ages = dict((bucket(m), m.get('age_min_months')) for m in milestones)
+	_apply_totals(sorted(counts.items(), key=lambda item: str(item[0])), ages, delta)
+
+# Adds delta to the catalog totals for every milestone given, one random
+# shard per bucket, with at most TXN_ENTITY_GROUPS counters per transaction
+def adjust_totals(milestones, delta):
+	counts = Counter(bucket(m) for m in milestones)
+	ages = dict((bucket(m), m.get('age_min_months')) for m in milestones)
+	buckets = sorted(counts.items(), key=lambda item: str(item[0]))
+	for start in range(0, len(buckets), TXN_ENTITY_GROUPS):
+		chunk = buckets[start:start + TXN_ENTITY_GROUPS]
+		run_in_transaction(client, lambda: _apply_totals(chunk, ages, delta))
+
+# Catalog totals summed over shards, as {(category, age): (count, age_min_months)}
+def catalog_totals():
+	totals = {}
+	for total in client.query(kind='milestone_totals').fetch():
+		key = (total['category'], total['age'])
+		count, age_min = totals.get(key, (0, None))
+		if total.get('age_min_months') is not None:
+			age_min = total['age_min_months']
+		totals[key] = (count + total['count'], age_min)
+	return totals
+
+# Progress of one child, grouped by category with one row per age band
+def child_progress(single_child):
+	done = dict(((e['category'], e['age']), e['done']) for e in single_child.get('progress') or [])
+	totals = catalog_totals()
+
+	categories = {}
+	for key in set(totals) | set(done):
+		count, age_min = totals.get(key, (0, None))
+		categories.setdefault(key[0], []).append({
+			'age': key[1],
+			'age_min_months': age_min,
+			'done': done.get(key, 0),
+			'total': max(count, 0)
+		})
+
+	results = []
+	for category in sorted(categories):
+		ages = sorted(categories[category], key=lambda e: (e['age_min_months'] is None, e['age_min_months'], e['age']))
+		results.append({
+			'category': category,
+			'done': sum(e['done'] for e in ages),
+			'total': sum(e['total'] for e in ages),
+			'ages': ages
+		})
+	return {
+		'done': sum(e['done'] for e in results),
+		'total': sum(e['total'] for e in results),
+		'categories': results
+	}
@@ -0,0 +1,166 @@
+# Sessions for the browser login flow
+#
+# A logged-in session holds only the user's key (their Auth0 sub). Where it
+# is kept is picked from the environment:
+#	SESSION_BACKEND=cookie (default)	Flask's signed cookie; with only the
+#										user key in it the cookie stays small,
+#										and it works on every instance and
+#										across restarts
+#	SESSION_BACKEND=redis				the cookie carries only a signed session
+#										id; data lives in any Redis-protocol
+#										server at REDIS_URL, shared by every
+#										instance, behind an in-process LRU
+#	SESSION_BACKEND=memory				in-process LRU only, so sessions are per
+#										instance; for local runs
+# With a shared backend the local LRU only holds sessions for
+# SESSION_LOCAL_TTL seconds, which bounds how long a logout on one instance
+# can go unnoticed on another.
+import os
+import secrets
+import threading
+
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+from cache import LRUCache, RedisCache
+from metrics import register_collector
+
+SESSION_TTL = 7 * 24 * 3600
+SESSION_LOCAL_TTL = 30
+SESSION_LRU_SIZE = 4096
+
+class ServerSideSession(CallbackDict, SessionMixin):
+	def __init__(self, initial=None, sid=None, new=False):
+		def on_update(self):
+			self.modified = True
+		CallbackDict.__init__(self, initial, on_update)
+		self.sid = sid
+		self.new = new
+		self.modified = False
+		self.previous_sid = None
+
+	# Issues a new session id on the next save, e.g. after login, so an id
+	# seen before authentication cannot be reused afterwards
+	def rotate(self):
+		self.previous_sid = self.previous_sid or self.sid
+		self.sid = secrets.token_urlsafe(24)
+		self.modified = True
+
+class SessionStore(object):
+	def __init__(self, shared=None, size=SESSION_LRU_SIZE):
+		self.local = LRUCache(size)
+		self.shared = shared
+		self._lock = threading.Lock()
+		self._stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+
+	def _count(self, name):
+		with self._lock:
+			self._stats[name] += 1
+
+	def get(self, sid):
+		data = self.local.get(sid)
+		if data is not None:
+			self._count('local_hits')
+			return data
+		if self.shared is not None:
+			data = self.shared.get('session:' + sid)
+			if data is not None:
+				self._count('shared_hits')
+				self.local.set(sid, data, SESSION_LOCAL_TTL)
+				return data
+		self._count('misses')
+		return None
+
+	def set(self, sid, data):
+		if self.shared is not None:
+			self.shared.set('session:' + sid, data, SESSION_TTL)
+			self.local.set(sid, data, SESSION_LOCAL_TTL)
+		else:
+			self.local.set(sid, data, SESSION_TTL)
+
+	def delete(self, sid):
+		self.local.delete(sid)
+		if self.shared is not None:
+			self.shared.delete('session:' + sid)
+
+	def stats(self):
+		with self._lock:
+			return dict(self._stats)
+
+class ServerSideSessionInterface(SessionInterface):
+	def __init__(self, store):
+		self.store = store
+
+	def _signer(self, app):
+		return Signer(app.secret_key, salt='session-id')
+
+	def open_session(self, app, request):
+		cookie = request.cookies.get(app.session_cookie_name)
+		if cookie:
+			try:
+				sid = self._signer(app).unsign(cookie).decode('ascii')
+			except BadSignature:
+				sid = None
+			if sid:
+				data = self.store.get(sid)
+				if data is not None:
+					return ServerSideSession(data, sid=sid)
+		return ServerSideSession(sid=secrets.token_urlsafe(24), new=True)
+
+	def save_session(self, app, session, response):
+		name = app.session_cookie_name
+		domain = self.get_cookie_domain(app)
+		path = self.get_cookie_path(app)
+		if session.previous_sid:
+			self.store.delete(session.previous_sid)
+
+		# Emptied sessions (logout) are dropped along with their cookie
+		if not session:
+			if session.modified and not session.new:
+				self.store.delete(session.sid)
+				response.delete_cookie(name, domain=domain, path=path)
+			return
+
+		if not session.modified and not self.should_set_cookie(app, session):
+			return
+		self.store.set(session.sid, dict(session))
+		response.set_cookie(
+			name,
+			self._signer(app).sign(session.sid).decode('ascii'),
+			expires=self.get_expiration_time(app, session),
+			httponly=self.get_cookie_httponly(app),
+			domain=domain,
+			path=path,
+			secure=self.get_cookie_secure(app),
+			samesite=self.get_cookie_samesite(app)
+		)
+
+def make_session_interface():
+	backend = os.environ.get('SESSION_BACKEND', 'cookie')
+	if backend == 'redis':
+		return ServerSideSessionInterface(SessionStore(RedisCache(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))))
+	if backend == 'memory':
+		return ServerSideSessionInterface(SessionStore())
+	return SecureCookieSessionInterface()
+
+session_interface = make_session_interface()
+
+# Starts a fresh logged-in session holding only the user key. Server-side
+# sessions also get a new id, so an id seen before login is not reused.
+def start_session(session, user_id):
+	session.clear()
+	if isinstance(session, ServerSideSession):
+		session.rotate()
+	session['user_id'] = user_id
+
+@register_collector
+def _session_metrics():
+	if not isinstance(session_interface, ServerSideSessionInterface):
+		return []
+	stats = session_interface.store.stats()
+	return [
+		('session_local_hits_total', 'counter', 'Sessions served from the in-process LRU.', stats['local_hits']),
+		('session_shared_hits_total', 'counter', 'Sessions loaded from the shared backend.', stats['shared_hits']),
+		('session_misses_total', 'counter', 'Session cookies whose session was not found.', stats['misses']),
+	]
@@ -0,0 +1,87 @@
+# Request coalescing for concurrent identical reads
+#
+# When several threads ask a SingleFlight group for the same key at once,
+# only the first (the leader) runs the load; the others wait for it and
+# share its result or exception. Nothing is kept once the load finishes;
+# it only collapses a burst of identical in-flight reads into one backend
+# call. A caller that joins a load may get a result read before its own
+# latest write, so reads that need to see their own writes should not go
+# through a group.
+import threading
+
+from metrics import register_collector
+
+class _Call(object):
+	def __init__(self):
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+
+class SingleFlight(object):
+	def __init__(self, name):
+		self.name = name
+		self._lock = threading.Lock()
+		self._calls = {}
+		self._stats = {'calls': 0, 'loads': 0, 'coalesced': 0}
+
+	# Returns load() for key, sharing one in-flight load between concurrent
+	# callers. When share is given every caller, the leader included, gets
+	# share(result), e.g. a copy, so callers can modify what they get back
+	# while the loaded result itself stays untouched.
+	def do(self, key, load, share=None):
+		with self._lock:
+			self._stats['calls'] += 1
+			call = self._calls.get(key)
+			leader = call is None
+			if leader:
+				call = self._calls[key] = _Call()
+				self._stats['loads'] += 1
+			else:
+				self._stats['coalesced'] += 1
+
+		if not leader:
+			call.done.wait()
+			if call.error is not None:
+				raise call.error
+			return share(call.result) if share else call.result
+
+		try:
+			call.result = load()
+			return share(call.result) if share else call.result
+		except Exception as error:
+			call.error = error
+			raise
+		finally:
+			with self._lock:
+				del self._calls[key]
+			call.done.set()
+
+	# Waits for the load in flight for key, if any, without starting one
+	def wait(self, key):
+		with self._lock:
+			call = self._calls.get(key)
+		if call is not None:
+			call.done.wait()
+
+	def stats(self):
+		with self._lock:
+			return dict(self._stats)
+
+_groups = []
+
+def group(name):
+	flight = SingleFlight(name)
+	_groups.append(flight)
+	return flight
+
+@register_collector
+def _singleflight_metrics():
+	metrics = []
+	for flight in _groups:
+		stats = flight.stats()
+		metrics.extend([
+			('singleflight_%s_calls_total' % flight.name, 'counter', 'Reads requested through the %s single-flight group.' % flight.name, stats['calls']),
+			('singleflight_%s_loads_total' % flight.name, 'counter', 'Reads that went to the backend.', stats['loads']),
+			('singleflight_%s_coalesced_total' % flight.name, 'counter', 'Reads that shared another caller\'s in-flight load.', stats['coalesced']),
+		])
+	return metrics
@@ -0,0 +1,250 @@
+# Background task queue for secondary updates
+#
+# Request handlers do their primary write and enqueue the follow-up work
+# (keeping users' children lists and other references in step) instead of
+# doing it on the client's critical path. Tasks are registered by name:
+#
+#	@task('add_child_to_user')
+#	def add_child_to_user(payload): ...
+#
+#	enqueue('add_child_to_user', {...}, task_id='add-child-123')
+#
+# Handlers may run more than once and must be idempotent. A task_id makes
+# enqueueing idempotent too: a task id that is pending or finished recently
+# is not queued again.
+#
+# The backend is picked from the environment:
+#	TASK_BACKEND=local (default)	in-process worker pool with retries
+#	TASK_BACKEND=http				push queue in the style of Cloud Tasks: each
+#									task is POSTed to TASKS_URL, which calls
+#									back POST /tasks/<name> on TASK_TARGET_URL
+#									(or this app's own url) and retries on
+#									failure; benchmarks/tasks_stub.py is a
+#									local stand-in
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Blueprint, has_request_context, request
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import Request, urlopen
+
+from helpers import json_response
+from config import secret_key
+from metrics import register_collector
+
+TASK_WORKERS = int(os.environ.get('TASK_WORKERS', '2'))
+TASK_MAX_ATTEMPTS = 5
+TASK_BACKOFF = 0.5
+TASK_MAX_BACKOFF = 30.0
+TASK_DEDUP_SIZE = 10000
+TASK_PUSH_TIMEOUT = 5
+
+bp = Blueprint('tasks', __name__, url_prefix='/tasks')
+
+_handlers = {}
+
+def task(name):
+	def register(fn):
+		_handlers[name] = fn
+		return fn
+	return register
+
+# Queue counters, exported on /metrics
+_stats_lock = threading.Lock()
+_stats = {'enqueued': 0, 'deduplicated': 0, 'started': 0, 'completed': 0, 'retried': 0, 'failed': 0, 'lag_seconds': 0.0, 'max_lag_seconds': 0.0}
+
+def _record(**deltas):
+	with _stats_lock:
+		for name, delta in deltas.items():
+			_stats[name] += delta
+
+def _record_start(due_at):
+	lag = max(0.0, time.time() - due_at)
+	with _stats_lock:
+		_stats['started'] += 1
+		_stats['lag_seconds'] += lag
+		_stats['max_lag_seconds'] = max(_stats['max_lag_seconds'], lag)
+
+def task_stats():
+	with _stats_lock:
+		stats = dict(_stats)
+	stats['pending'] = queue.pending()
+	stats['backend'] = type(queue).__name__
+	return stats
+
+# Runs one delivery of a task; True when it succeeded
+def _run(name, payload, due_at):
+	_record_start(due_at)
+	try:
+		_handlers[name](payload)
+	except Exception:
+		logging.exception('Task %s failed', name)
+		return False
+	_record(completed=1)
+	return True
+
+def _backoff(attempt):
+	return min(TASK_MAX_BACKOFF, TASK_BACKOFF * 2 ** attempt)
+
+class LocalQueue(object):
+	def __init__(self, workers=TASK_WORKERS):
+		self.workers = workers
+		self._cond = threading.Condition()
+		self._heap = []
+		self._seq = itertools.count()
+		self._ids = OrderedDict()
+		self._running = 0
+		self._threads = []
+
+	def _start(self):
+		# Workers start with the first task, so importing the app stays cheap
+		while len(self._threads) < self.workers:
+			thread = threading.Thread(target=self._work, name='task-worker', daemon=True)
+			thread.start()
+			self._threads.append(thread)
+
+	def put(self, name, payload, task_id, delay):
+		with self._cond:
+			if task_id is not None:
+				if task_id in self._ids:
+					return False
+				self._ids[task_id] = True
+				while len(self._ids) > TASK_DEDUP_SIZE:
+					self._ids.popitem(last=False)
+			heapq.heappush(self._heap, (time.time() + delay, next(self._seq), name, payload, 0))
+			self._start()
+			self._cond.notify()
+			return True
+
+	def _work(self):
+		while True:
+			with self._cond:
+				while not self._heap or self._heap[0][0] > time.time():
+					self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+				due_at, seq, name, payload, attempt = heapq.heappop(self._heap)
+				self._running += 1
+			succeeded = _run(name, payload, due_at)
+			with self._cond:
+				self._running -= 1
+				if not succeeded:
+					if attempt + 1 < TASK_MAX_ATTEMPTS:
+						_record(retried=1)
+						heapq.heappush(self._heap, (time.time() + _backoff(attempt), next(self._seq), name, payload, attempt + 1))
+						self._cond.notify()
+					else:
+						_record(failed=1)
+						logging.error('Task %s gave up after %d attempts: %s', name, TASK_MAX_ATTEMPTS, json.dumps(payload))
+				self._cond.notify_all()
+
+	def pending(self):
+		with self._cond:
+			return len(self._heap) + self._running
+
+	# Blocks until every queued task has finished or timeout passes;
+	# True when the queue drained
+	def join(self, timeout=None):
+		deadline = None if timeout is None else time.time() + timeout
+		with self._cond:
+			while self._heap or self._running:
+				remaining = None if deadline is None else deadline - time.time()
+				if remaining is not None and remaining <= 0:
+					return False
+				self._cond.wait(remaining if remaining is not None else 1.0)
+		return True
+
+# Token the push queue sends back on /tasks/<name>, so only it can run tasks
+def task_token():
+	return hmac.new(secret_key().encode('utf-8'), b'tasks', hashlib.sha256).hexdigest()
+
+class HttpQueue(object):
+	def __init__(self, url, target_url=None):
+		self.url = url.rstrip('/')
+		self.target_url = target_url
+
+	def _target(self, name):
+		base = self.target_url or (request.url_root if has_request_context() else None)
+		if not base:
+			raise RuntimeError('TASK_TARGET_URL must be set to enqueue tasks outside a request')
+		return base.rstrip('/') + '/tasks/' + name
+
+	def put(self, name, payload, task_id, delay):
+		due_at = time.time() + delay
+		body = json.dumps({
+			'name': task_id,
+			'url': self._target(name),
+			'headers': {'X-Task-Token': task_token()},
+			'body': {'payload': payload, 'due_at': due_at},
+			'schedule_time': due_at,
+			'max_attempts': TASK_MAX_ATTEMPTS
+		}).encode('utf-8')
+		push = Request(self.url + '/tasks', data=body, headers={'Content-Type': 'application/json'})
+		try:
+			urlopen(push, timeout=TASK_PUSH_TIMEOUT).read()
+		except HTTPError as error:
+			# The queue already holds a task with this name
+			if error.code == 409:
+				return False
+			raise
+		return True
+
+	def pending(self):
+		return None
+
+def make_queue():
+	if os.environ.get('TASK_BACKEND', 'local') == 'http':
+		return HttpQueue(os.environ['TASKS_URL'], os.environ.get('TASK_TARGET_URL'))
+	return LocalQueue()
+
+queue = make_queue()
+
+# Queues name(payload) to run after delay seconds. Returns False when a
+# task with the same task_id was already queued.
+def enqueue(name, payload, task_id=None, delay=0):
+	if name not in _handlers:
+		raise KeyError('No task registered as ' + name)
+	queued = queue.put(name, payload, task_id, delay)
+	_record(**{'enqueued' if queued else 'deduplicated': 1})
+	return queued
+
+# Push endpoint for the http backend. Non-2xx responses make the queue
+# retry the delivery.
+@bp.route('/<name>', methods = ['POST'])
+def run_task(name):
+	if not hmac.compare_digest(request.headers.get('X-Task-Token', ''), task_token()):
+		return json_response({'Error': 'Tasks can only be run by the task queue.'}, 403)
+	if name not in _handlers:
+		return json_response({'Error': 'No task with this name exists.'}, 404)
+	body = request.get_json()
+	retries = int(request.headers.get('X-CloudTasks-TaskRetryCount', '0'))
+	if retries:
+		_record(retried=1)
+	if not _run(name, body['payload'], body.get('due_at', time.time())):
+		if retries + 1 >= TASK_MAX_ATTEMPTS:
+			_record(failed=1)
+		return json_response({'Error': 'The task failed.'}, 500)
+	return json_response({}, 204)
+
+@register_collector
+def _task_metrics():
+	stats = task_stats()
+	metrics = [
+		('tasks_enqueued_total', 'counter', 'Tasks queued.', stats['enqueued']),
+		('tasks_deduplicated_total', 'counter', 'Enqueues skipped because the task id was already queued.', stats['deduplicated']),
+		('tasks_started_total', 'counter', 'Task deliveries started, including retries.', stats['started']),
+		('tasks_completed_total', 'counter', 'Task deliveries that succeeded.', stats['completed']),
+		('tasks_retried_total', 'counter', 'Task deliveries retried after a failure.', stats['retried']),
+		('tasks_failed_total', 'counter', 'Tasks that failed on every attempt.', stats['failed']),
+		('tasks_lag_seconds_total', 'counter', 'Time from when a delivery was due to when it started.', stats['lag_seconds']),
+		('tasks_max_lag_seconds', 'gauge', 'Longest delay from due to started.', stats['max_lag_seconds']),
+	]
+	if stats['pending'] is not None:
+		metrics.append(('tasks_pending', 'gauge', 'Tasks queued or running in this process.', stats['pending']))
+	return metrics
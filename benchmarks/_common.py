@@ -0,0 +1,343 @@
+# Shared setup for the benchmark scripts.
+#
+# The app modules read osu.us.auth0.json from the working directory at import
+# time, so benchmarks run from a scratch directory holding a fake config that
+# points Auth0 at the local stub servers below.
+import base64
+import itertools
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'JohnsJoe_finalproject')
+
+BENCH_CLIENT_ID = 'bench-client-id'
+BENCH_KID = 'bench-kid'
+BENCH_SUB = 'auth0|bench-user'
+
+# Request bodies the app-level benchmarks seed through the API
+BENCH_MILESTONE = {
+	'activity': 'Place baby tummy down on a blanket and move the blanket slowly around the room.',
+	'age': '0-1 month',
+	'category': 'Physical',
+	'milestone': 'Moves head from side to side while lying on stomach'
+}
+BENCH_CHILD = {'first_name': 'Austin', 'gender': 'male', 'birthday': '07/2019'}
+
+
+def use_project(domain='127.0.0.1:0'):
+	"""Make the app modules importable with a fake Auth0 config."""
+	workdir = tempfile.mkdtemp(prefix='cs493-bench-')
+	with open(os.path.join(workdir, 'osu.us.auth0.json'), 'w') as f:
+		json.dump({
+			'client_id': BENCH_CLIENT_ID,
+			'client_secret': 'bench-secret',
+			'domain': domain
+		}, f)
+	os.chdir(workdir)
+	sys.path.insert(0, os.path.abspath(PROJECT_DIR))
+	return workdir
+
+
+def percentiles(samples):
+	"""Return p50/p95/p99 (milliseconds) of a list of second timings."""
+	ordered = sorted(samples)
+	def pick(p):
+		return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))] * 1000
+	return {
+		'n': len(ordered),
+		'p50': pick(0.50),
+		'p95': pick(0.95),
+		'p99': pick(0.99),
+		'mean': statistics.mean(ordered) * 1000,
+	}
+
+
+def format_row(label, stats):
+	return '%-28s n=%-6d p50=%8.3fms p95=%8.3fms p99=%8.3fms mean=%8.3fms' % (
+		label, stats['n'], stats['p50'], stats['p95'], stats['p99'], stats['mean'])
+
+
+def timed(fn, iterations):
+	samples = []
+	for _ in range(iterations):
+		start = time.perf_counter()
+		fn()
+		samples.append(time.perf_counter() - start)
+	return samples
+
+
+def _b64(number):
+	raw = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+	return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+class SigningKey(object):
+	"""RSA key pair used to mint RS256 tokens the stub JWKS server vouches for."""
+
+	def __init__(self, kid=BENCH_KID):
+		from cryptography.hazmat.primitives import serialization
+		from cryptography.hazmat.primitives.asymmetric import rsa
+
+		self.kid = kid
+		self._key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+		self.pem = self._key.private_bytes(
+			serialization.Encoding.PEM,
+			serialization.PrivateFormat.TraditionalOpenSSL,
+			serialization.NoEncryption()).decode('ascii')
+		numbers = self._key.public_key().public_numbers()
+		self.jwk = {
+			'kty': 'RSA',
+			'kid': kid,
+			'use': 'sig',
+			'alg': 'RS256',
+			'n': _b64(numbers.n),
+			'e': _b64(numbers.e),
+		}
+
+	def token(self, domain, sub=BENCH_SUB, lifetime=3600):
+		from jose import jwt
+
+		now = int(time.time())
+		claims = {
+			'sub': sub,
+			'aud': BENCH_CLIENT_ID,
+			'iss': 'https://' + domain + '/',
+			'iat': now,
+			'exp': now + lifetime,
+		}
+		return jwt.encode(claims, self.pem, algorithm='RS256', headers={'kid': self.kid})
+
+
+class StubJWKSServer(object):
+	"""Serves /.well-known/jwks.json locally with optional artificial latency."""
+
+	def __init__(self, keys, latency=0.0):
+		self.keys = keys
+		self.latency = latency
+		self.hits = 0
+		stub = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path != '/.well-known/jwks.json':
+					self.send_error(404)
+					return
+				stub.hits += 1
+				if stub.latency:
+					time.sleep(stub.latency)
+				body = json.dumps({'keys': [k.jwk for k in stub.keys]}).encode('utf-8')
+				self.send_response(200)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+
+		self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+	@property
+	def domain(self):
+		return '127.0.0.1:%d' % self._server.server_address[1]
+
+	@property
+	def url(self):
+		return 'http://' + self.domain + '/.well-known/jwks.json'
+
+	def start(self):
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self._server.shutdown()
+
+
+def emulator_client(namespace=None):
+	"""Datastore client bound to the emulator named by DATASTORE_EMULATOR_HOST."""
+	if not os.environ.get('DATASTORE_EMULATOR_HOST'):
+		sys.exit('Start the emulator first, e.g.\n'
+				 '  gcloud beta emulators datastore start --no-store-on-disk\n'
+				 '  $(gcloud beta emulators datastore env-init)')
+	from google.cloud import datastore
+
+	project = os.environ.get('DATASTORE_PROJECT_ID', 'cs493-bench')
+	return datastore.Client(project=project, namespace=namespace)
+
+
+def fresh_namespace(prefix):
+	"""Unique namespace so repeated runs do not see each other's entities."""
+	return '%s-%d' % (prefix, int(time.time() * 1000))
+
+
+def put_in_chunks(client, entities, size=500):
+	for start in range(0, len(entities), size):
+		client.put_multi(entities[start:start + size])
+
+
+class CountingIterator(object):
+	"""Counts the rows a query iterator returns, i.e. billed entity reads."""
+
+	def __init__(self, iterator):
+		self.iterator = iterator
+		self.rows = 0
+
+	@property
+	def pages(self):
+		for page in self.iterator.pages:
+			rows = list(page)
+			self.rows += len(rows)
+			yield rows
+
+	@property
+	def next_page_token(self):
+		return self.iterator.next_page_token
+
+
+class FakeRequest(object):
+	"""The subset of flask.request that helpers.verify_jwt reads."""
+
+	def __init__(self, token):
+		self.headers = {'Authorization': 'Bearer ' + token}
+
+
+def free_port():
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+
+class AppServer(object):
+	"""Runs the app in a subprocess, as WSGI (gunicorn) or ASGI (uvicorn).
+
+	The server runs from the scratch directory made by use_project(), talks to
+	the emulator named by DATASTORE_EMULATOR_HOST and verifies tokens against
+	jwks_url.
+	"""
+
+	def __init__(self, mode, jwks_url, workers=1, threads=1, extra_env=None):
+		self.port = free_port()
+		self.url = 'http://127.0.0.1:%d' % self.port
+		if mode == 'wsgi':
+			command = ['gunicorn', '-b', '127.0.0.1:%d' % self.port, '-w', str(workers),
+					   '--threads', str(threads), 'main:app']
+		elif mode == 'asgi':
+			command = ['uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(self.port),
+					   '--workers', str(workers), '--log-level', 'warning']
+		else:
+			raise ValueError('mode must be wsgi or asgi')
+		env = dict(os.environ)
+		env['PYTHONPATH'] = os.path.abspath(PROJECT_DIR) + os.pathsep + env.get('PYTHONPATH', '')
+		env['JWKS_URL'] = jwks_url
+		env.update(extra_env or {})
+		self.command = command
+		self.env = env
+		self.process = None
+
+	def start(self, timeout=30):
+		self.process = subprocess.Popen(self.command, env=self.env, cwd=os.getcwd())
+		deadline = time.time() + timeout
+		while time.time() < deadline:
+			try:
+				urlopen(self.url + '/milestones', timeout=1)
+				return self
+			except HTTPError:
+				return self
+			except (URLError, OSError):
+				time.sleep(0.2)
+		self.stop()
+		raise RuntimeError('App server did not start: ' + ' '.join(self.command))
+
+	def stop(self):
+		if self.process and self.process.poll() is None:
+			self.process.terminate()
+			self.process.wait(timeout=10)
+
+
+def call(method, url, token=None, body=None, headers=None):
+	"""Makes one JSON request; returns (status, response headers, decoded body)."""
+	data = None if body is None else json.dumps(body).encode('utf-8')
+	request = Request(url, data=data, method=method)
+	request.add_header('Accept', 'application/json')
+	if data is not None:
+		request.add_header('Content-Type', 'application/json')
+	if token:
+		request.add_header('Authorization', 'Bearer ' + token)
+	for name, value in (headers or {}).items():
+		request.add_header(name, value)
+	try:
+		response = urlopen(request, timeout=30)
+		status, response_headers, raw = response.status, response.headers, response.read()
+	except HTTPError as error:
+		status, response_headers, raw = error.code, error.headers, error.read()
+	try:
+		decoded = json.loads(raw) if raw else None
+	except ValueError:
+		decoded = raw
+	return status, response_headers, decoded
+
+
+def run_load(specs, concurrency, duration, on_response=None):
+	"""Replays request specs round-robin from concurrency threads for duration
+	seconds. Each spec is a dict with label, method, url and optional token,
+	body, headers. Returns (label -> latency samples, error count, elapsed).
+	"""
+	cycle = itertools.cycle(specs)
+	lock = threading.Lock()
+	samples = {}
+	errors = [0]
+	deadline = time.time() + duration
+
+	def worker():
+		while time.time() < deadline:
+			with lock:
+				spec = next(cycle)
+			start = time.perf_counter()
+			try:
+				status, headers, body = call(spec['method'], spec['url'], spec.get('token'),
+											 spec.get('body'), spec.get('headers'))
+			except Exception:
+				status, headers, body = 0, {}, None
+			elapsed = time.perf_counter() - start
+			with lock:
+				samples.setdefault(spec['label'], []).append(elapsed)
+				if status == 0 or status >= 500:
+					errors[0] += 1
+				if on_response:
+					on_response(spec, status, headers, body)
+
+	started = time.time()
+	threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return samples, errors[0], time.time() - started
+
+
+def seed_user(client, sub=BENCH_SUB):
+	"""Stores the user entity the app expects for sub."""
+	from google.cloud import datastore
+
+	user = datastore.Entity(key=client.key('users', sub))
+	user.update({'user_id': sub, 'name': 'bench', 'picture': '', 'checkmarked': [], 'children': []})
+	client.put(user)
+
+
+def create(server, token, path, body):
+	"""POSTs body to path on server and returns the new entity's id."""
+	status, headers, created = call('POST', server.url + path, token, body)
+	if status != 201:
+		raise RuntimeError('Seeding %s failed with %s: %s' % (path, status, created))
+	return created['id']
@@ -0,0 +1,54 @@
+"""
+Compares the per-milestone client.get loop used by
+GET /children/<id>/milestones with the batched helpers.get_multi_ordered
+lookup, for children with a growing number of assigned milestones.
+
+Usage:
+  $(gcloud beta emulators datastore env-init)
+  python benchmarks/bench_child_milestones.py [--counts 1,10,40,100] [--repeats 20]
+"""
+import argparse
+
+import _common
+
+
+def seed(client, count):
+	from google.cloud import datastore
+
+	milestones = []
+	for i in range(count):
+		milestone = datastore.Entity(key=client.key('milestones'))
+		milestone.update({
+			'activity': 'Activity %d' % i,
+			'age': '0-1 month',
+			'category': 'Physical',
+			'milestone': 'Milestone %d' % i
+		})
+		milestones.append(milestone)
+	_common.put_in_chunks(client, milestones)
+	return [client.key('milestones', m.key.id) for m in milestones]
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--counts', default='1,10,40,100')
+	parser.add_argument('--repeats', type=int, default=20)
+	args = parser.parse_args()
+
+	_common.use_project()
+	import helpers
+
+	client = _common.emulator_client(_common.fresh_namespace('child-milestones'))
+	for count in [int(c) for c in args.counts.split(',')]:
+		keys = seed(client, count)
+		print('== %d assigned milestones ==' % count)
+
+		serial = _common.timed(lambda: [client.get(key=key) for key in keys], args.repeats)
+		batched = _common.timed(lambda: helpers.get_multi_ordered(client, keys), args.repeats)
+		print(_common.format_row('serial client.get', _common.percentiles(serial)), 'rpcs=%d' % count)
+		print(_common.format_row('get_multi_ordered', _common.percentiles(batched)),
+			  'rpcs=%d' % -(-count // helpers.MAX_LOOKUP_KEYS))
+
+
+if __name__ == '__main__':
+	main()
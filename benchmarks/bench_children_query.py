@@ -0,0 +1,97 @@
+"""
+Compares the old fetch-then-filter GET /children query with the indexed
+owner query, as the total number of children in the kind grows.
+
+Usage:
+  $(gcloud beta emulators datastore env-init)
+  python benchmarks/bench_children_query.py [--sizes 100,1000,5000] [--users 50]
+
+For each size the kind is seeded with children spread evenly across --users
+owners. Both strategies then collect one owner's complete list five at a
+time, the way a client follows the 'next' links, and the script reports the
+latency and the number of entities Datastore returned (and billed).
+"""
+import argparse
+import time
+
+import _common
+
+
+def legacy_walk(client, owner):
+	# Mirrors the pre-index handler: offset pages over the whole kind,
+	# filtered in Python
+	rows = 0
+	found = []
+	offset = 0
+	while True:
+		iterator = _common.CountingIterator(client.query(kind='children').fetch(limit=5, offset=offset))
+		page = next(iterator.pages)
+		rows += iterator.rows
+		found.extend(e for e in page if e['user_id'] == owner)
+		if not iterator.next_page_token:
+			return found, rows
+		offset += 5
+
+
+def indexed_walk(client, owner):
+	rows = 0
+	found = []
+	offset = 0
+	while True:
+		query = client.query(kind='children')
+		query.add_filter('user_id', '=', owner)
+		query.order = ['first_name']
+		iterator = _common.CountingIterator(query.fetch(limit=5, offset=offset))
+		page = next(iterator.pages)
+		rows += iterator.rows
+		found.extend(page)
+		if not iterator.next_page_token:
+			return found, rows
+		offset += 5
+
+
+def seed(client, size, users):
+	from google.cloud import datastore
+
+	entities = []
+	for i in range(size):
+		child = datastore.Entity(key=client.key('children'))
+		child.update({
+			'first_name': 'child-%06d' % i,
+			'gender': 'female' if i % 2 else 'male',
+			'birthday': '07/2020',
+			'user_id': 'auth0|user-%d' % (i % users),
+			'milestones_assigned': []
+		})
+		entities.append(child)
+	_common.put_in_chunks(client, entities)
+
+
+def measure(walk, client, owner, repeats):
+	samples = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		found, rows = walk(client, owner)
+		samples.append(time.perf_counter() - start)
+	return _common.percentiles(samples), len(found), rows
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--sizes', default='100,1000,5000')
+	parser.add_argument('--users', type=int, default=50)
+	parser.add_argument('--repeats', type=int, default=5)
+	args = parser.parse_args()
+
+	for size in [int(s) for s in args.sizes.split(',')]:
+		client = _common.emulator_client(_common.fresh_namespace('children-query'))
+		seed(client, size, args.users)
+		owner = 'auth0|user-0'
+		print('== %d children, %d users ==' % (size, args.users))
+		for label, walk in (('fetch-then-filter', legacy_walk), ('indexed owner query', indexed_walk)):
+			stats, found, rows = measure(walk, client, owner, args.repeats)
+			print(_common.format_row(label, stats), 'returned=%d entity_reads=%d' % (found, rows))
+
+
+if __name__ == '__main__':
+	main()
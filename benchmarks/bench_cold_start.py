@@ -0,0 +1,62 @@
+"""
+Measures cold start: wall time from a fresh interpreter importing main to
+the first response, split into import time and first-request time.
+
+Usage: python benchmarks/bench_cold_start.py [--runs 10] [--path /]
+       python benchmarks/bench_cold_start.py --project-dir /path/to/other/checkout
+
+Each run starts a new Python process, so module imports, config parsing,
+Datastore client construction and OAuth registration are all counted. Pass
+--project-dir to compare against another checkout (e.g. a git worktree of
+an older commit). --path / renders the home page, which needs no Datastore;
+other paths need DATASTORE_EMULATOR_HOST.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import _common
+
+PROBE = '''
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+app = getattr(main, 'app')
+response = app.test_client().get(%r, headers={'Accept': 'application/json'})
+done = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_response': done - imported, 'status': response.status_code}))
+'''
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--runs', type=int, default=10)
+	parser.add_argument('--path', default='/')
+	parser.add_argument('--project-dir', default=_common.PROJECT_DIR)
+	args = parser.parse_args()
+
+	_common.use_project()
+	env = dict(os.environ)
+	env['PYTHONPATH'] = os.path.abspath(args.project_dir)
+	# Give the client a project so it does not probe for credentials
+	env.setdefault('GOOGLE_CLOUD_PROJECT', 'cs493-bench')
+
+	imports, firsts, totals = [], [], []
+	for _ in range(args.runs):
+		output = subprocess.check_output([sys.executable, '-c', PROBE % args.path], env=env, cwd=os.getcwd())
+		result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+		imports.append(result['import'])
+		firsts.append(result['first_response'])
+		totals.append(result['import'] + result['first_response'])
+
+	print('== %s, GET %s (status %d) ==' % (os.path.abspath(args.project_dir), args.path, result['status']))
+	print(_common.format_row('import main', _common.percentiles(imports)))
+	print(_common.format_row('first response', _common.percentiles(firsts)))
+	print(_common.format_row('import to first response', _common.percentiles(totals)))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,93 @@
+"""
+Microbenchmark of the JSON response encoders on realistic payloads: a page
+of children with embedded milestone summaries and a page of milestones,
+built as datastore.Entity objects the way the handlers return them.
+
+Usage: python benchmarks/bench_encoders.py [--page-size 100] [--iterations 2000]
+
+Compares stdlib json, orjson (if installed) and each of them followed by
+gzip / brotli (if installed) at the levels helpers.json_response uses.
+"""
+import argparse
+import gzip
+import json
+
+import _common
+
+
+def make_entity(values):
+	from google.cloud import datastore
+
+	entity = datastore.Entity()
+	entity.update(values)
+	return entity
+
+
+def milestone(i):
+	return {
+		'id': 5629499534213120 + i,
+		'self': 'https://cs493finalproject.wm.r.appspot.com/milestones/%d' % (5629499534213120 + i),
+		'activity': 'Place baby tummy down on a blanket and move the blanket slowly around the room.',
+		'age': '0-1 month',
+		'category': 'Physical',
+		'milestone': 'Moves head from side to side while lying on stomach',
+	}
+
+
+def payloads(page_size):
+	children = []
+	for i in range(page_size):
+		children.append(make_entity({
+			'id': 4785074604081152 + i,
+			'first_name': 'Austin',
+			'gender': 'male',
+			'birthday': '07/2019',
+			'user_id': 'auth0|60a2e4a7cbc3e700700e4f7c',
+			'self': 'https://cs493finalproject.wm.r.appspot.com/children/%d' % (4785074604081152 + i),
+			'milestones_assigned': [milestone(j) for j in range(12)],
+		}))
+	milestones = [make_entity(milestone(i)) for i in range(page_size)]
+	return {
+		'children page': {'children': children, 'next': 'https://example/children?page_token=abc'},
+		'milestones page': {'milestones': milestones, 'next': 'https://example/milestones?page_token=abc'},
+	}
+
+
+def encoders():
+	found = [('json', lambda obj: json.dumps(obj).encode('utf-8'))]
+	try:
+		import orjson
+		found.append(('orjson', orjson.dumps))
+	except ImportError:
+		print('orjson not installed; skipping')
+	return found
+
+
+def compressors():
+	found = [('identity', lambda body: body), ('gzip', lambda body: gzip.compress(body, compresslevel=6))]
+	try:
+		import brotli
+		found.append(('br', lambda body: brotli.compress(body, quality=4)))
+	except ImportError:
+		print('brotli not installed; skipping')
+	return found
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--page-size', type=int, default=100)
+	parser.add_argument('--iterations', type=int, default=2000)
+	args = parser.parse_args()
+
+	for name, payload in payloads(args.page_size).items():
+		print('== %s (%d items) ==' % (name, args.page_size))
+		for encoder_name, encode in encoders():
+			for compressor_name, compress in compressors():
+				size = len(compress(encode(payload)))
+				samples = _common.timed(lambda: compress(encode(payload)), args.iterations)
+				print(_common.format_row('%s + %s' % (encoder_name, compressor_name), _common.percentiles(samples)),
+					  'bytes=%d' % size)
+
+
+if __name__ == '__main__':
+	main()
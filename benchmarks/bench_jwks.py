@@ -0,0 +1,62 @@
+"""
+Compares helpers.verify_jwt latency with and without the JWKS and
+verified-token caches.
+
+Usage: python benchmarks/bench_jwks.py [--iterations N] [--latency SECONDS]
+
+A local stub JWKS server stands in for Auth0; --latency simulates the
+round trip to https://<domain>/.well-known/jwks.json.
+"""
+import argparse
+
+import _common
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--iterations', type=int, default=500)
+	parser.add_argument('--latency', type=float, default=0.03)
+	args = parser.parse_args()
+
+	key = _common.SigningKey()
+	server = _common.StubJWKSServer([key], latency=args.latency).start()
+	_common.use_project(domain=server.domain)
+
+	import helpers
+	helpers.JWKS_URL = server.url
+
+	token = key.token(server.domain)
+	request = _common.FakeRequest(token)
+
+	def uncached():
+		helpers.clear_jwks_cache()
+		helpers.clear_token_cache()
+		helpers.verify_jwt(request)
+
+	def cached():
+		helpers.clear_token_cache()
+		helpers.verify_jwt(request)
+
+	def token_cached():
+		helpers.verify_jwt(request)
+
+	server.hits = 0
+	cold = _common.percentiles(_common.timed(uncached, args.iterations))
+	uncached_hits = server.hits
+
+	server.hits = 0
+	helpers.clear_jwks_cache()
+	warm = _common.percentiles(_common.timed(cached, args.iterations))
+	cached_hits = server.hits
+
+	helpers.clear_token_cache()
+	repeat = _common.percentiles(_common.timed(token_cached, args.iterations))
+
+	print(_common.format_row('verify_jwt (no cache)', cold), 'jwks_fetches=%d' % uncached_hits)
+	print(_common.format_row('verify_jwt (jwks cache)', warm), 'jwks_fetches=%d' % cached_hits)
+	print(_common.format_row('verify_jwt (token cache)', repeat), helpers.token_cache_stats())
+	server.stop()
+
+
+if __name__ == '__main__':
+	main()
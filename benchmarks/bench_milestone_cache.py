@@ -0,0 +1,84 @@
+"""
+Measures GET /milestones/<id> lookups through the milestone read-through
+cache against direct Datastore reads, for the in-process LRU backend and the
+Redis-protocol backend (served by resp_stub.py unless --redis-url is given).
+
+Usage:
+  $(gcloud beta emulators datastore env-init)
+  python benchmarks/bench_milestone_cache.py [--milestones 200] [--requests 5000]
+"""
+import argparse
+import random
+
+import _common
+import resp_stub
+
+
+def seed(client, count):
+	from google.cloud import datastore
+
+	milestones = []
+	for i in range(count):
+		milestone = datastore.Entity(key=client.key('milestones'))
+		milestone.update({
+			'activity': 'Activity %d' % i,
+			'age': '0-1 month',
+			'category': 'Physical',
+			'milestone': 'Milestone %d' % i
+		})
+		milestones.append(milestone)
+	_common.put_in_chunks(client, milestones)
+	return [m.key.id for m in milestones]
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--milestones', type=int, default=200)
+	parser.add_argument('--requests', type=int, default=5000)
+	parser.add_argument('--redis-url', default=None)
+	args = parser.parse_args()
+
+	_common.use_project()
+	import cache
+
+	client = _common.emulator_client(_common.fresh_namespace('milestone-cache'))
+	ids = seed(client, args.milestones)
+	# Popular milestones are requested far more often than the rest
+	workload = [random.choice(ids[:max(1, len(ids) // 10)]) if random.random() < 0.8 else random.choice(ids)
+				for _ in range(args.requests)]
+
+	def load(milestone_id):
+		entity = client.get(key=client.key('milestones', milestone_id))
+		return dict(entity) if entity else None
+
+	direct = iter(workload)
+	samples = _common.timed(lambda: load(next(direct)), len(workload))
+	print(_common.format_row('datastore only', _common.percentiles(samples)))
+
+	stand_in = None
+	redis_url = args.redis_url
+	if redis_url is None:
+		stand_in = resp_stub.RESPServer().start()
+		redis_url = stand_in.url
+
+	for label, backend in (('lru cache', cache.LRUCache()), ('redis cache', cache.RedisCache(redis_url))):
+		backend.clear()
+		read_through = cache.ReadThroughCache(backend)
+		requests = iter(workload)
+
+		def cached():
+			milestone_id = next(requests)
+			read_through.get_or_load(cache.milestone_key(milestone_id), lambda: load(milestone_id))
+
+		samples = _common.timed(cached, len(workload))
+		stats = read_through.stats()
+		print(_common.format_row(label, _common.percentiles(samples)),
+			  'hit_ratio=%.3f avg_cache_ms=%.3f avg_datastore_ms=%.3f' % (
+				  stats['hit_ratio'], stats['avg_cache_ms'], stats['avg_datastore_ms']))
+
+	if stand_in:
+		stand_in.shutdown()
+
+
+if __name__ == '__main__':
+	main()
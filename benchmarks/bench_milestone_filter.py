@@ -0,0 +1,101 @@
+"""
+Compares finding the milestones for one category and age range by paging
+through the whole catalog and filtering on the client (what the app does
+today) with the server-side ?category=&min_age=&max_age=&sort=age query.
+
+Usage:
+  $(gcloud beta emulators datastore env-init)
+  pip install gunicorn cryptography
+  python benchmarks/bench_milestone_filter.py [--size 2000] [--limit 5] [--category Physical] [--min-age 3 --max-age 6]
+
+The catalog is seeded through /milestones:batch with a spread of categories
+and ages. Each strategy follows the "next" links to the last page and the
+report shows requests, bytes transferred, wall time and whether both found
+the same milestones. The first walk is cold; the second is served by the
+milestone page cache.
+"""
+import argparse
+import json
+import time
+
+import _common
+
+CATEGORIES = ['Physical', 'Social', 'Language', 'Cognitive']
+AGES = ['0-1 month', '1-2 months', '2-3 months', '3-4 months', '4-6 months', '6-9 months',
+		'9-12 months', '1-2 years', '2-3 years', '3-5 years']
+
+
+def seed(server, size):
+	items = []
+	for i in range(size):
+		items.append({
+			'activity': 'Activity %d' % i,
+			'age': AGES[i % len(AGES)],
+			'category': CATEGORIES[(i // len(AGES)) % len(CATEGORIES)],
+			'milestone': 'Milestone %05d' % i
+		})
+	for start in range(0, len(items), 500):
+		status, headers, body = _common.call('POST', server.url + '/milestones:batch', body=items[start:start + 500])
+		if status != 200:
+			raise RuntimeError('Seeding failed with %s: %s' % (status, body))
+
+
+def walk(url):
+	# Follows next links; returns (milestones, requests, bytes, seconds)
+	milestones = []
+	requests = 0
+	transferred = 0
+	start = time.perf_counter()
+	while url:
+		status, headers, body = _common.call('GET', url)
+		if status != 200:
+			raise RuntimeError('GET %s returned %s: %s' % (url, status, body))
+		requests += 1
+		transferred += len(json.dumps(body))
+		milestones.extend(body['milestones'])
+		url = body.get('next')
+	return milestones, requests, transferred, time.perf_counter() - start
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--size', type=int, default=2000)
+	parser.add_argument('--limit', type=int, default=5)
+	parser.add_argument('--category', default='Physical')
+	parser.add_argument('--min-age', type=float, default=3)
+	parser.add_argument('--max-age', type=float, default=6)
+	args = parser.parse_args()
+
+	key = _common.SigningKey()
+	jwks = _common.StubJWKSServer([key]).start()
+	_common.use_project(domain=jwks.domain)
+	server = _common.AppServer('wsgi', jwks.url).start()
+	try:
+		seed(server, args.size)
+
+		def wanted(milestone):
+			age = milestone.get('age_min_months')
+			return (milestone['category'] == args.category and age is not None
+					and args.min_age <= age <= args.max_age)
+
+		client_url = '%s/milestones?limit=%d' % (server.url, args.limit)
+		server_url = '%s/milestones?limit=%d&category=%s&min_age=%s&max_age=%s&sort=age' % (
+			server.url, args.limit, args.category, args.min_age, args.max_age)
+
+		print('%-22s %6s %9s %12s %10s %8s' % ('strategy', 'pass', 'requests', 'bytes', 'seconds', 'matches'))
+		found = {}
+		for label, url, local_filter in (('client-side filter', client_url, True), ('server-side query', server_url, False)):
+			for run in ('cold', 'warm'):
+				milestones, requests, transferred, elapsed = walk(url)
+				if local_filter:
+					milestones = [m for m in milestones if wanted(m)]
+				found[label] = set(m['id'] for m in milestones)
+				print('%-22s %6s %9d %12d %10.3f %8d' % (label, run, requests, transferred, elapsed, len(milestones)))
+		print('same results: %s' % (found['client-side filter'] == found['server-side query']))
+	finally:
+		server.stop()
+		jwks.stop()
+
+
+if __name__ == '__main__':
+	main()
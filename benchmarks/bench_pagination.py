@@ -0,0 +1,87 @@
+"""
+Walks deep pages of the milestones kind with offset pagination and with
+cursor (page_token) pagination and reports how per-page latency grows with
+depth.
+
+Usage:
+  $(gcloud beta emulators datastore env-init)
+  python benchmarks/bench_pagination.py [--size 5000] [--limit 5] [--report-every 100]
+
+Offset pages make Datastore read and discard every skipped entity, so page N
+costs roughly N * limit reads; a cursor page costs limit reads at any depth.
+"""
+import argparse
+import time
+
+import _common
+
+
+def seed(client, size):
+	from google.cloud import datastore
+
+	entities = []
+	for i in range(size):
+		milestone = datastore.Entity(key=client.key('milestones'))
+		milestone.update({
+			'activity': 'Activity %d' % i,
+			'age': '0-1 month',
+			'category': 'Physical',
+			'milestone': 'Milestone %d' % i
+		})
+		entities.append(milestone)
+	_common.put_in_chunks(client, entities)
+
+
+def walk(client, limit, use_cursor):
+	# Yields (page number, seconds, estimated entity reads) for every page
+	offset = 0
+	cursor = None
+	page_number = 0
+	while True:
+		query = client.query(kind='milestones')
+		start = time.perf_counter()
+		if use_cursor:
+			iterator = query.fetch(limit=limit, start_cursor=cursor)
+		else:
+			iterator = query.fetch(limit=limit, offset=offset)
+		page = list(next(iterator.pages))
+		elapsed = time.perf_counter() - start
+		reads = len(page) + (0 if use_cursor else offset)
+		yield page_number, elapsed, reads
+		if not iterator.next_page_token or not page:
+			return
+		page_number += 1
+		offset += limit
+		cursor = iterator.next_page_token
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--size', type=int, default=5000)
+	parser.add_argument('--limit', type=int, default=5)
+	parser.add_argument('--report-every', type=int, default=100)
+	args = parser.parse_args()
+
+	client = _common.emulator_client(_common.fresh_namespace('pagination'))
+	seed(client, args.size)
+
+	for label, use_cursor in (('offset', False), ('cursor', True)):
+		print('== %s pagination, %d milestones, limit=%d ==' % (label, args.size, args.limit))
+		window = []
+		total_reads = 0
+		total_time = 0.0
+		for page_number, elapsed, reads in walk(client, args.limit, use_cursor):
+			window.append(elapsed)
+			total_reads += reads
+			total_time += elapsed
+			if len(window) == args.report_every:
+				print(_common.format_row('pages %d-%d' % (page_number - len(window) + 1, page_number),
+										 _common.percentiles(window)))
+				window = []
+		if window:
+			print(_common.format_row('remaining pages', _common.percentiles(window)))
+		print('total: %.3fs, estimated entity reads=%d' % (total_time, total_reads))
+
+
+if __name__ == '__main__':
+	main()
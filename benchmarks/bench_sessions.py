@@ -0,0 +1,117 @@
+"""
+Compares the old signed-cookie session (raw id_token, userinfo and profile
+in the cookie) with the compact session (only the user key, in the signed
+cookie or server-side behind a signed session id): cookie size and
+per-request handling time for a logged-in request.
+
+Usage:
+  pip install cryptography
+  python benchmarks/bench_sessions.py [--iterations 5000] [--redis-url redis://...]
+
+Runs in-process with Flask's test client, so no emulator is needed. The
+shared-backend case uses resp_stub.py unless --redis-url is given.
+"""
+import argparse
+import time
+
+import _common
+import resp_stub
+
+
+def userinfo(sub):
+	# Shape of an Auth0 /userinfo response for a Google login
+	return {
+		'sub': sub,
+		'given_name': 'Bench',
+		'family_name': 'User',
+		'nickname': 'bench.user',
+		'name': 'Bench User',
+		'picture': 'https://lh3.googleusercontent.com/a-/AOh14GhExampleExampleExampleExampleExample=s96-c',
+		'locale': 'en',
+		'updated_at': '2021-06-05T18:00:00.000Z',
+		'email': 'bench.user@example.com',
+		'email_verified': True
+	}
+
+
+def make_app(mode, token, store=None):
+	from flask import Flask, session
+
+	import sessions
+
+	app = Flask(__name__)
+	app.secret_key = 'bench-secret-key'
+	if mode == 'server':
+		app.session_interface = sessions.ServerSideSessionInterface(store)
+
+	@app.route('/login')
+	def login():
+		info = userinfo('auth0|bench-user')
+		if mode == 'before':
+			session['token'] = token
+			session['jwt_payload'] = info
+			session['profile'] = {'user_id': info['sub'], 'name': info['name'], 'picture': info['picture']}
+		else:
+			sessions.start_session(session, info['sub'])
+		return 'ok'
+
+	@app.route('/whoami')
+	def whoami():
+		if mode == 'before':
+			return session['profile']['user_id']
+		return session['user_id']
+
+	return app
+
+
+def measure(app, iterations):
+	test_client = app.test_client()
+	response = test_client.get('/login')
+	if response.status_code != 200:
+		raise RuntimeError('/login returned %s' % response.status_code)
+	cookie = response.headers.get('Set-Cookie', '').split(';', 1)[0]
+	samples = []
+	for _ in range(iterations):
+		start = time.perf_counter()
+		response = test_client.get('/whoami')
+		samples.append(time.perf_counter() - start)
+		if response.status_code != 200:
+			raise RuntimeError('/whoami returned %s' % response.status_code)
+	return len(cookie), samples
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--iterations', type=int, default=5000)
+	parser.add_argument('--redis-url')
+	args = parser.parse_args()
+
+	_common.use_project()
+	import cache
+	import sessions
+
+	token = _common.SigningKey().token('bench.example.com')
+	stand_in = None
+	redis_url = args.redis_url
+	if not redis_url:
+		stand_in = resp_stub.RESPServer().start()
+		redis_url = stand_in.url
+
+	cases = [
+		('cookie session (before)', make_app('before', token)),
+		('compact cookie session', make_app('cookie', token)),
+		('server-side, LRU', make_app('server', token, sessions.SessionStore())),
+		('server-side, LRU+redis', make_app('server', token, sessions.SessionStore(cache.RedisCache(redis_url)))),
+	]
+	try:
+		for label, app in cases:
+			cookie_bytes, samples = measure(app, args.iterations)
+			print('%s: Cookie header %d bytes' % (label, cookie_bytes))
+			print(_common.format_row(label, _common.percentiles(samples)))
+	finally:
+		if stand_in:
+			stand_in.shutdown()
+
+
+if __name__ == '__main__':
+	main()
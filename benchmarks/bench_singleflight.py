@@ -0,0 +1,120 @@
+"""
+Concurrency test for the single-flight read layer: many threads read the
+same hot key at once, through plain client.get and through
+helpers.get_shared, and the number of Datastore lookups each approach sent
+is compared.
+
+Usage:
+  $(gcloud beta emulators datastore env-init)
+  python benchmarks/bench_singleflight.py [--threads 32] [--rounds 200] [--keys 1] [--latency 0.02]
+
+Every round releases all threads together on a barrier, like a burst of
+requests for one popular milestone. The emulator answers in well under a
+millisecond, so --latency adds a delay to each lookup to stand in for the
+network round trip to Datastore. The script exits non-zero if every
+get_shared caller did not get the entity or if coalescing saved no RPCs.
+"""
+import argparse
+import random
+import threading
+import time
+
+import _common
+
+
+class CountingClient(object):
+	"""Wraps a Datastore client, counting and delaying lookups."""
+
+	def __init__(self, client, latency):
+		self.client = client
+		self.latency = latency
+		self.lookups = 0
+		self._lock = threading.Lock()
+
+	def get(self, key):
+		with self._lock:
+			self.lookups += 1
+		time.sleep(self.latency)
+		return self.client.get(key)
+
+	@property
+	def current_transaction(self):
+		return self.client.current_transaction
+
+
+def seed(client, count):
+	from google.cloud import datastore
+
+	keys = []
+	for i in range(count):
+		milestone = datastore.Entity(key=client.key('milestones', i + 1))
+		milestone.update({'activity': 'Activity %d' % i, 'age': '0-1 month', 'category': 'Physical', 'milestone': 'Milestone %d' % i})
+		client.put(milestone)
+		keys.append(milestone.key)
+	return keys
+
+
+def burst(read, keys, threads, rounds):
+	barrier = threading.Barrier(threads)
+	samples = []
+	misses = [0]
+	lock = threading.Lock()
+
+	def worker(index):
+		rng = random.Random(index)
+		for _ in range(rounds):
+			key = rng.choice(keys)
+			barrier.wait()
+			start = time.perf_counter()
+			entity = read(key)
+			elapsed = time.perf_counter() - start
+			with lock:
+				samples.append(elapsed)
+				if entity is None or entity.key != key:
+					misses[0] += 1
+
+	workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+	for thread in workers:
+		thread.start()
+	for thread in workers:
+		thread.join()
+	return samples, misses[0]
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--threads', type=int, default=32)
+	parser.add_argument('--rounds', type=int, default=200)
+	parser.add_argument('--keys', type=int, default=1, help='distinct hot keys read per burst')
+	parser.add_argument('--latency', type=float, default=0.02, help='seconds added to each lookup')
+	args = parser.parse_args()
+
+	_common.use_project()
+	import helpers
+
+	raw = _common.emulator_client(_common.fresh_namespace('singleflight'))
+	keys = seed(raw, args.keys)
+
+	failed = False
+	results = {}
+	for label in ('client.get', 'get_shared'):
+		client = CountingClient(raw, args.latency)
+		if label == 'client.get':
+			read = client.get
+		else:
+			read = lambda key: helpers.get_shared(client, key)
+		samples, misses = burst(read, keys, args.threads, args.rounds)
+		results[label] = client.lookups
+		failed = failed or misses > 0
+		print(_common.format_row(label, _common.percentiles(samples)))
+		print('%s: %d reads, %d Datastore lookups, %d wrong results' % (label, len(samples), client.lookups, misses))
+
+	stats = helpers._shared_reads.stats()
+	print('single-flight: %d calls, %d loads, %d coalesced' % (stats['calls'], stats['loads'], stats['coalesced']))
+	print('lookups saved: %.1f%%' % (100.0 * (1 - float(results['get_shared']) / results['client.get'])))
+	failed = failed or results['get_shared'] >= results['client.get']
+	raise SystemExit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,73 @@
+"""
+Request-level check of conditional GETs: each cacheable route is fetched
+once for its ETag, then again with If-None-Match, and must answer 304 with
+an empty body; after a write it must answer 200 with a new ETag.
+
+Usage:
+  $(gcloud beta emulators datastore env-init)
+  pip install gunicorn cryptography
+  python benchmarks/check_conditional_get.py
+
+Exits non-zero if any route fails.
+"""
+import argparse
+
+import _common
+
+def check(url, token=None):
+	# Returns (ok, message, etag) after a plain GET and a conditional one
+	status, headers, body = _common.call('GET', url, token)
+	etag = headers.get('ETag')
+	if status != 200 or not etag:
+		return False, 'GET returned %s with ETag %r' % (status, etag), etag
+	status, headers, body = _common.call('GET', url, token, headers={'If-None-Match': etag})
+	if status != 304 or body:
+		return False, 'If-None-Match %s returned %s' % (etag, status), etag
+	return True, '304 for %s' % etag, etag
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.parse_args()
+
+	key = _common.SigningKey()
+	jwks = _common.StubJWKSServer([key]).start()
+	_common.use_project(domain=jwks.domain)
+	token = key.token(jwks.domain, sub=_common.BENCH_SUB)
+	_common.seed_user(_common.emulator_client())
+
+	server = _common.AppServer('wsgi', jwks.url).start()
+	failed = False
+	try:
+		milestone_id = _common.create(server, token, '/milestones', _common.BENCH_MILESTONE)
+		child_id = _common.create(server, token, '/children', _common.BENCH_CHILD)
+		routes = [
+			('/milestones', None),
+			('/milestones/%s' % milestone_id, None),
+			('/children', token),
+			('/children/%s' % child_id, token),
+			('/children/%s/milestones' % child_id, token),
+		]
+		etags = {}
+		for path, route_token in routes:
+			ok, message, etags[path] = check(server.url + path, route_token)
+			failed = failed or not ok
+			print('%-5s GET %s: %s' % ('ok' if ok else 'FAIL', path, message))
+
+		# A write must change the ETag of the child's representations
+		status, headers, body = _common.call('PUT', '%s/children/%s/milestones/%s' % (server.url, child_id, milestone_id), token)
+		if status != 204:
+			raise RuntimeError('Assigning the milestone returned %s: %s' % (status, body))
+		for path in ('/children/%s' % child_id, '/children/%s/milestones' % child_id):
+			status, headers, body = _common.call('GET', server.url + path, token, headers={'If-None-Match': etags[path]})
+			ok = status == 200 and headers.get('ETag') != etags[path]
+			failed = failed or not ok
+			print('%-5s GET %s after a write: %s' % ('ok' if ok else 'FAIL', path, status))
+	finally:
+		server.stop()
+		jwks.stop()
+	raise SystemExit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+	main()
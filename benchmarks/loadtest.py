@@ -0,0 +1,66 @@
+"""
+Load test comparing requests/sec of the WSGI setup (gunicorn main:app, as
+App Engine runs it) with the ASGI serving mode (uvicorn asgi:app).
+
+Usage:
+  $(gcloud beta emulators datastore env-init)
+  pip install gunicorn uvicorn asgiref cryptography
+  python benchmarks/loadtest.py [--concurrency 32] [--duration 20] [--workers 1]
+
+A stub JWKS server stands in for Auth0. The mix exercises the authenticated
+child reads, the child-assignment PUT/DELETE pair and the milestone catalog.
+"""
+import argparse
+
+import _common
+
+
+def request_mix(server, token):
+	milestone_id = _common.create(server, token, '/milestones', _common.BENCH_MILESTONE)
+	child_id = _common.create(server, token, '/children', _common.BENCH_CHILD)
+	base = server.url
+	return [
+		{'label': 'GET /milestones', 'method': 'GET', 'url': base + '/milestones'},
+		{'label': 'GET /milestones/<id>', 'method': 'GET', 'url': base + '/milestones/%s' % milestone_id},
+		{'label': 'GET /children', 'method': 'GET', 'url': base + '/children', 'token': token},
+		{'label': 'GET /children/<id>', 'method': 'GET', 'url': base + '/children/%s' % child_id, 'token': token},
+		{'label': 'PUT assignment', 'method': 'PUT', 'token': token,
+		 'url': base + '/children/%s/milestones/%s' % (child_id, milestone_id)},
+		{'label': 'DELETE assignment', 'method': 'DELETE', 'token': token,
+		 'url': base + '/children/%s/milestones/%s' % (child_id, milestone_id)},
+	]
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--concurrency', type=int, default=32)
+	parser.add_argument('--duration', type=float, default=20)
+	parser.add_argument('--workers', type=int, default=1)
+	parser.add_argument('--modes', default='wsgi,asgi')
+	args = parser.parse_args()
+
+	key = _common.SigningKey()
+	jwks = _common.StubJWKSServer([key]).start()
+	_common.use_project(domain=jwks.domain)
+	token = key.token(jwks.domain, lifetime=24 * 3600)
+	_common.seed_user(_common.emulator_client())
+
+	for mode in args.modes.split(','):
+		server = _common.AppServer(mode, jwks.url, workers=args.workers).start()
+		try:
+			specs = request_mix(server, token)
+			samples, errors, elapsed = _common.run_load(specs, args.concurrency, args.duration)
+		finally:
+			server.stop()
+
+		total = sum(len(s) for s in samples.values())
+		print('== %s: %d workers, concurrency %d ==' % (mode, args.workers, args.concurrency))
+		print('throughput: %.1f req/s over %.1fs, errors=%d' % (total / elapsed, elapsed, errors))
+		for label, route_samples in sorted(samples.items()):
+			print(_common.format_row(label, _common.percentiles(route_samples)))
+
+	jwks.stop()
+
+
+if __name__ == '__main__':
+	main()
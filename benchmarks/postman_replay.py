@@ -0,0 +1,251 @@
+"""
+Replays the flows in JohnsJoe_project.postman_collection.json against the app
+running locally (Datastore emulator + stub Auth0/JWKS server) and reports
+throughput, p50/p95/p99 and Datastore ops per request for each route.
+
+Usage:
+  $(gcloud beta emulators datastore env-init)
+  pip install gunicorn cryptography
+  python benchmarks/postman_replay.py [--users 8] [--duration 30] [--mode wsgi]
+  python benchmarks/postman_replay.py --save-baseline main
+  python benchmarks/postman_replay.py --compare main [--tolerance 0.2]
+
+Each virtual user walks the whole collection in order, in a loop, with its
+own copy of the Postman environment, so ids captured by the collection's
+test scripts (pm.environment.set(..., pm.response.json()["id"])) flow into
+later requests exactly as they do in Postman. Datastore ops are read from
+the Server-Timing header. Baselines are stored in benchmarks/baselines/;
+--compare exits non-zero if any route's p95 or Datastore ops regress.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import _common
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+COLLECTION = os.path.join(ROOT, 'JohnsJoe_project.postman_collection.json')
+ENVIRONMENT = os.path.join(ROOT, 'JohnsJoe_project.postman_environment.json')
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+VARIABLE = re.compile(r'\{\{(\w+)\}\}')
+CAPTURE = re.compile(r'pm\.environment\.set\("(\w+)",\s*pm\.response\.json\(\)\["(\w+)"\]\)')
+SERVER_TIMING_CALLS = re.compile(r'(\w+)=(\d+)')
+
+
+def load_steps(path):
+	"""Flattens the collection into replayable steps, in order."""
+	with open(path) as f:
+		collection = json.load(f)
+	default_auth = collection.get('auth')
+
+	steps = []
+
+	def walk(items):
+		for item in items:
+			if 'item' in item:
+				walk(item['item'])
+				continue
+			request = item['request']
+			url = request['url']['raw'] if isinstance(request['url'], dict) else request['url']
+			auth = request.get('auth', default_auth) or {}
+			token = None
+			for entry in auth.get('bearer', []):
+				if entry['key'] == 'token':
+					token = entry['value']
+			captures = []
+			for event in item.get('event', []):
+				for line in event.get('script', {}).get('exec', []):
+					captures.extend(CAPTURE.findall(line))
+			body = (request.get('body') or {}).get('raw') or None
+			steps.append({
+				'name': item['name'],
+				'method': request['method'],
+				'url': url,
+				'route': request['method'] + ' ' + url.replace('{{app_url}}', ''),
+				'headers': dict((h['key'], h['value']) for h in request.get('header', []) if h.get('key') and not h.get('disabled')),
+				'body': body,
+				'token': token,
+				'captures': captures,
+			})
+
+	walk(collection['item'])
+	return steps
+
+
+def load_environment(path):
+	with open(path) as f:
+		environment = json.load(f)
+	return dict((v['key'], v['value']) for v in environment['values'] if v.get('enabled', True))
+
+
+def substitute(text, variables):
+	if text is None:
+		return None
+	return VARIABLE.sub(lambda m: str(variables.get(m.group(1), m.group(0))), text)
+
+
+def datastore_ops(headers):
+	timing = headers.get('Server-Timing', '') if headers else ''
+	for part in timing.split(','):
+		if part.strip().startswith('datastore'):
+			return sum(int(count) for op, count in SERVER_TIMING_CALLS.findall(part.split('desc=')[-1]))
+	return None
+
+
+def play(step, variables):
+	url = substitute(step['url'], variables)
+	body = substitute(step['body'], variables)
+	headers = dict((k, substitute(v, variables)) for k, v in step['headers'].items())
+	token = substitute(step['token'], variables)
+	try:
+		decoded = json.loads(body) if body else None
+	except ValueError:
+		decoded = None
+	status, response_headers, response = _common.call(step['method'], url, token, decoded, headers)
+	for variable, field in step['captures']:
+		if isinstance(response, dict) and field in response:
+			variables[variable] = response[field]
+	return status, response_headers
+
+
+def replay(steps, environment, users, duration):
+	results = {}
+	lock = threading.Lock()
+	deadline = time.time() + duration
+
+	def virtual_user():
+		variables = dict(environment)
+		while time.time() < deadline:
+			for step in steps:
+				if time.time() >= deadline:
+					return
+				start = time.perf_counter()
+				try:
+					status, headers = play(step, variables)
+				except Exception:
+					status, headers = 0, None
+				elapsed = time.perf_counter() - start
+				ops = datastore_ops(headers)
+				with lock:
+					route = results.setdefault(step['route'], {'samples': [], 'ops': [], 'errors': 0})
+					route['samples'].append(elapsed)
+					if ops is not None:
+						route['ops'].append(ops)
+					if status == 0 or status >= 500:
+						route['errors'] += 1
+
+	started = time.time()
+	threads = [threading.Thread(target=virtual_user) for _ in range(users)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return results, time.time() - started
+
+
+def summarize(results, elapsed):
+	summary = {'routes': {}, 'elapsed': elapsed}
+	total = 0
+	for route, data in sorted(results.items()):
+		stats = _common.percentiles(data['samples'])
+		stats['rps'] = len(data['samples']) / elapsed
+		stats['errors'] = data['errors']
+		stats['datastore_ops'] = sum(data['ops']) / len(data['ops']) if data['ops'] else None
+		summary['routes'][route] = stats
+		total += len(data['samples'])
+	summary['throughput'] = total / elapsed
+	return summary
+
+
+def print_summary(summary):
+	print('throughput: %.1f req/s over %.1fs' % (summary['throughput'], summary['elapsed']))
+	for route, stats in summary['routes'].items():
+		ops = '-' if stats['datastore_ops'] is None else '%.1f' % stats['datastore_ops']
+		print('%-70s %7.1f req/s p50=%8.2fms p95=%8.2fms p99=%8.2fms ds_ops=%s errors=%d' % (
+			route, stats['rps'], stats['p50'], stats['p95'], stats['p99'], ops, stats['errors']))
+
+
+def compare(summary, baseline, tolerance):
+	regressions = []
+	for route, stats in summary['routes'].items():
+		before = baseline['routes'].get(route)
+		if not before:
+			continue
+		if stats['p95'] > before['p95'] * (1 + tolerance):
+			regressions.append('%s: p95 %.2fms -> %.2fms' % (route, before['p95'], stats['p95']))
+		if stats['datastore_ops'] is not None and before.get('datastore_ops') is not None \
+				and stats['datastore_ops'] > before['datastore_ops'] + 0.01:
+			regressions.append('%s: datastore ops %.1f -> %.1f' % (route, before['datastore_ops'], stats['datastore_ops']))
+	if summary['throughput'] < baseline['throughput'] * (1 - tolerance):
+		regressions.append('throughput %.1f -> %.1f req/s' % (baseline['throughput'], summary['throughput']))
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--users', type=int, default=8, help='concurrent virtual users')
+	parser.add_argument('--duration', type=float, default=30)
+	parser.add_argument('--mode', default='wsgi', choices=['wsgi', 'asgi'])
+	parser.add_argument('--workers', type=int, default=1)
+	parser.add_argument('--threads', type=int, default=8)
+	parser.add_argument('--save-baseline', metavar='NAME')
+	parser.add_argument('--compare', metavar='NAME')
+	parser.add_argument('--tolerance', type=float, default=0.2)
+	args = parser.parse_args()
+
+	steps = load_steps(COLLECTION)
+	environment = load_environment(ENVIRONMENT)
+
+	key = _common.SigningKey()
+	jwks = _common.StubJWKSServer([key]).start()
+	_common.use_project(domain=jwks.domain)
+
+	# Each collection token gets a fresh stub-signed token for its own user
+	from google.cloud import datastore
+	client = _common.emulator_client()
+	for index, name in enumerate(('jwt1', 'jwt2')):
+		sub = 'auth0|replay-user-%d' % (index + 1)
+		environment[name] = key.token(jwks.domain, sub=sub, lifetime=24 * 3600)
+		environment['user_id%d' % (index + 1)] = sub
+		user = datastore.Entity(key=client.key('users', sub))
+		user.update({'user_id': sub, 'name': sub, 'picture': '', 'checkmarked': [], 'children': []})
+		client.put(user)
+
+	server = _common.AppServer(args.mode, jwks.url, workers=args.workers, threads=args.threads).start()
+	environment['app_url'] = server.url
+	try:
+		results, elapsed = replay(steps, environment, args.users, args.duration)
+	finally:
+		server.stop()
+		jwks.stop()
+
+	summary = summarize(results, elapsed)
+	summary['config'] = {'users': args.users, 'mode': args.mode, 'workers': args.workers, 'threads': args.threads}
+	print_summary(summary)
+
+	if args.save_baseline:
+		os.makedirs(BASELINES, exist_ok=True)
+		path = os.path.join(BASELINES, args.save_baseline + '.json')
+		with open(path, 'w') as f:
+			json.dump(summary, f, indent=2, sort_keys=True)
+		print('Saved baseline to ' + path)
+
+	if args.compare:
+		with open(os.path.join(BASELINES, args.compare + '.json')) as f:
+			baseline = json.load(f)
+		regressions = compare(summary, baseline, args.tolerance)
+		if regressions:
+			print('Regressions against baseline %r:' % args.compare)
+			for line in regressions:
+				print('  ' + line)
+			sys.exit(1)
+		print('No regressions against baseline %r' % args.compare)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,128 @@
+"""
+Minimal in-memory Redis-protocol (RESP2) server, enough for cache.RedisCache
+to run locally without a real Redis: PING, GET, SET [EX|PX], DEL, INCR,
+FLUSHDB/FLUSHALL.
+
+Usage: python benchmarks/resp_stub.py [--port 6399]
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+
+class Store(object):
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.data = {}
+
+	def get(self, key):
+		entry = self.data.get(key)
+		if entry is None:
+			return None
+		value, expires_at = entry
+		if expires_at is not None and expires_at <= time.monotonic():
+			del self.data[key]
+			return None
+		return value
+
+
+def _encode(value):
+	if value is None:
+		return b'$-1\r\n'
+	if isinstance(value, int):
+		return b':%d\r\n' % value
+	if isinstance(value, str):
+		return ('+' + value + '\r\n').encode('utf-8')
+	return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+def _error(message):
+	return ('-ERR ' + message + '\r\n').encode('utf-8')
+
+
+def execute(store, args):
+	command = args[0].upper()
+	with store.lock:
+		if command == b'PING':
+			return _encode('PONG')
+		if command == b'GET':
+			return _encode(store.get(args[1]))
+		if command == b'SET':
+			expires_at = None
+			options = [a.upper() for a in args[3:]]
+			if b'EX' in options:
+				expires_at = time.monotonic() + int(args[3 + options.index(b'EX') + 1])
+			elif b'PX' in options:
+				expires_at = time.monotonic() + int(args[3 + options.index(b'PX') + 1]) / 1000.0
+			store.data[args[1]] = (args[2], expires_at)
+			return _encode('OK')
+		if command == b'DEL':
+			removed = sum(1 for key in args[1:] if store.data.pop(key, None) is not None)
+			return _encode(removed)
+		if command == b'INCR':
+			value = int(store.get(args[1]) or b'0') + 1
+			store.data[args[1]] = (str(value).encode('ascii'), None)
+			return _encode(value)
+		if command in (b'FLUSHDB', b'FLUSHALL'):
+			store.data.clear()
+			return _encode('OK')
+		if command == b'HELLO':
+			# Newer redis clients negotiate RESP3 and read the reply as a map
+			proto = int(args[1]) if len(args) > 1 else 2
+			fields = [('server', 'redis'), ('version', '7.0.0'), ('proto', proto), ('mode', 'standalone')]
+			if proto == 3:
+				return b'%' + str(len(fields)).encode('ascii') + b'\r\n' + b''.join(_encode(k) + _encode(v) for k, v in fields)
+			return b'*' + str(2 * len(fields)).encode('ascii') + b'\r\n' + b''.join(_encode(k) + _encode(v) for k, v in fields)
+		if command in (b'SELECT', b'CLIENT'):
+			return _encode('OK')
+	return _error('unknown command ' + command.decode('utf-8', 'replace'))
+
+
+def _read_command(rfile):
+	line = rfile.readline()
+	if not line:
+		return None
+	if not line.startswith(b'*'):
+		return line.split()
+	args = []
+	for _ in range(int(line[1:])):
+		length = int(rfile.readline()[1:])
+		args.append(rfile.read(length + 2)[:-2])
+	return args
+
+
+class RESPServer(socketserver.ThreadingTCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address=('127.0.0.1', 0)):
+		self.store = Store()
+		server = self
+
+		class Handler(socketserver.StreamRequestHandler):
+			def handle(self):
+				while True:
+					args = _read_command(self.rfile)
+					if not args:
+						return
+					self.wfile.write(execute(server.store, args))
+
+		socketserver.ThreadingTCPServer.__init__(self, address, Handler)
+
+	@property
+	def url(self):
+		return 'redis://127.0.0.1:%d/0' % self.server_address[1]
+
+	def start(self):
+		threading.Thread(target=self.serve_forever, daemon=True).start()
+		return self
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--port', type=int, default=6399)
+	args = parser.parse_args()
+	server = RESPServer(('127.0.0.1', args.port))
+	print('RESP stand-in listening on ' + server.url)
+	server.serve_forever()
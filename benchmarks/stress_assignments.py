@@ -0,0 +1,123 @@
+"""
+Stress test for concurrent child-milestone assignments: many clients toggle
+milestones on the same child at once, then the final state is checked for
+lost updates and throughput is reported against contention.
+
+Usage:
+  $(gcloud beta emulators datastore env-init)
+  pip install gunicorn cryptography
+  python benchmarks/stress_assignments.py [--levels 1,2,4,8,16] [--duration 10] [--milestones 4]
+
+Each client owns a disjoint set of milestones and keeps toggling one at
+random (PUT if it believes it is unassigned, DELETE otherwise), updating its
+expected state only on a 204. Because every assignment of one child rewrites
+the same child entity, concurrent clients conflict on commit; the server
+retries those transactions with backoff. At the end the child's
+milestones_assigned list and its assignment entities must both equal the
+union of what the clients expect, otherwise an update was lost. Retry and
+failure counts are scraped from /metrics.
+"""
+import argparse
+import random
+import re
+import threading
+import time
+
+import _common
+
+def scrape(server, name):
+	status, headers, body = _common.call('GET', server.url + '/metrics')
+	text = body.decode('utf-8') if isinstance(body, bytes) else str(body)
+	match = re.search(r'^%s (\S+)$' % name, text, re.M)
+	return float(match.group(1)) if match else 0.0
+
+
+def run_level(server, token, client, clients, milestones_each, duration):
+	child_id = _common.create(server, token, '/children', _common.BENCH_CHILD)
+	owned = [[_common.create(server, token, '/milestones', _common.BENCH_MILESTONE) for _ in range(milestones_each)] for _ in range(clients)]
+	expected = [set() for _ in range(clients)]
+	counts = {'ok': 0, 'conflict': 0, 'error': 0}
+	lock = threading.Lock()
+	deadline = time.time() + duration
+	retries_before = scrape(server, 'datastore_transaction_retries_total')
+	failures_before = scrape(server, 'datastore_transaction_failures_total')
+
+	def worker(index):
+		rng = random.Random(index)
+		while time.time() < deadline:
+			milestone_id = rng.choice(owned[index])
+			method = 'DELETE' if milestone_id in expected[index] else 'PUT'
+			url = '%s/children/%s/milestones/%s' % (server.url, child_id, milestone_id)
+			status, headers, body = _common.call(method, url, token)
+			if status == 204:
+				expected[index].symmetric_difference_update([milestone_id])
+				outcome = 'ok'
+			elif status == 409:
+				outcome = 'conflict'
+			else:
+				outcome = 'error'
+			with lock:
+				counts[outcome] += 1
+
+	started = time.time()
+	threads = [threading.Thread(target=worker, args=(index,)) for index in range(clients)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	elapsed = time.time() - started
+
+	# Compare what the clients saw succeed with what Datastore holds
+	want = set().union(*expected)
+	child = client.get(client.key('children', child_id))
+	listed = set(e['id'] for e in child['milestones_assigned'])
+	query = client.query(kind='assignments', ancestor=child.key)
+	query.keys_only()
+	stored = set(e.key.id_or_name for e in query.fetch())
+	lost = len(want ^ listed) + len(want ^ stored)
+
+	return {
+		'requests': sum(counts.values()),
+		'throughput': sum(counts.values()) / elapsed,
+		'conflicts': counts['conflict'],
+		'errors': counts['error'],
+		'retries': scrape(server, 'datastore_transaction_retries_total') - retries_before,
+		'failures': scrape(server, 'datastore_transaction_failures_total') - failures_before,
+		'lost': lost,
+	}
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--levels', default='1,2,4,8,16', help='comma-separated client counts')
+	parser.add_argument('--duration', type=float, default=10)
+	parser.add_argument('--milestones', type=int, default=4, help='milestones owned by each client')
+	parser.add_argument('--threads', type=int, default=16, help='gunicorn threads')
+	args = parser.parse_args()
+
+	key = _common.SigningKey()
+	jwks = _common.StubJWKSServer([key]).start()
+	_common.use_project(domain=jwks.domain)
+	token = key.token(jwks.domain, sub=_common.BENCH_SUB, lifetime=24 * 3600)
+	client = _common.emulator_client()
+	_common.seed_user(client)
+
+	# One worker process so /metrics covers every request
+	server = _common.AppServer('wsgi', jwks.url, workers=1, threads=args.threads).start()
+	failed = False
+	try:
+		print('%8s %9s %10s %9s %9s %9s %7s %5s' % ('clients', 'requests', 'req/s', 'retries', 'failures', 'conflict', 'errors', 'lost'))
+		for clients in [int(level) for level in args.levels.split(',')]:
+			result = run_level(server, token, client, clients, args.milestones, args.duration)
+			failed = failed or result['lost'] > 0 or result['errors'] > 0
+			print('%8d %9d %10.1f %9d %9d %9d %7d %5d' % (
+				clients, result['requests'], result['throughput'], result['retries'],
+				result['failures'], result['conflicts'], result['errors'], result['lost']))
+	finally:
+		server.stop()
+		jwks.stop()
+	raise SystemExit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,139 @@
+"""
+Minimal push task queue in the style of Cloud Tasks, enough for the app's
+TASK_BACKEND=http mode to run locally.
+
+Usage:
+  python benchmarks/tasks_stub.py [--port 8123] [--workers 4]
+  TASK_BACKEND=http TASKS_URL=http://127.0.0.1:8123 TASK_TARGET_URL=http://127.0.0.1:8080 python main.py
+
+POST /tasks takes {name, url, headers, body, schedule_time, max_attempts}
+and returns 409 if a task with the same name was already accepted. Each
+task is POSTed to its url once it is due; non-2xx responses are retried
+with exponential backoff, and the attempt number is sent in
+X-CloudTasks-TaskRetryCount. GET /tasks reports queue counters.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+
+
+class TaskQueue(object):
+	def __init__(self, workers=4):
+		self.cond = threading.Condition()
+		self.heap = []
+		self.seq = itertools.count()
+		self.names = set()
+		self.stats = {'accepted': 0, 'duplicates': 0, 'delivered': 0, 'retried': 0, 'failed': 0}
+		for _ in range(workers):
+			threading.Thread(target=self.work, daemon=True).start()
+
+	def add(self, task):
+		with self.cond:
+			if task.get('name'):
+				if task['name'] in self.names:
+					self.stats['duplicates'] += 1
+					return False
+				self.names.add(task['name'])
+			self.stats['accepted'] += 1
+			heapq.heappush(self.heap, (task.get('schedule_time') or time.time(), next(self.seq), task, 0))
+			self.cond.notify()
+			return True
+
+	def deliver(self, task, attempt):
+		data = json.dumps(task['body']).encode('utf-8')
+		request = Request(task['url'], data=data, method='POST')
+		request.add_header('Content-Type', 'application/json')
+		request.add_header('X-CloudTasks-TaskRetryCount', str(attempt))
+		for name, value in task.get('headers', {}).items():
+			request.add_header(name, value)
+		try:
+			urlopen(request, timeout=30).read()
+			return True
+		except (HTTPError, URLError, OSError):
+			return False
+
+	def work(self):
+		while True:
+			with self.cond:
+				while not self.heap or self.heap[0][0] > time.time():
+					self.cond.wait(self.heap[0][0] - time.time() if self.heap else None)
+				due, seq, task, attempt = heapq.heappop(self.heap)
+			delivered = self.deliver(task, attempt)
+			with self.cond:
+				if delivered:
+					self.stats['delivered'] += 1
+				elif attempt + 1 < task.get('max_attempts', 5):
+					self.stats['retried'] += 1
+					delay = min(MAX_BACKOFF, BACKOFF * 2 ** attempt)
+					heapq.heappush(self.heap, (time.time() + delay, next(self.seq), task, attempt + 1))
+					self.cond.notify()
+				else:
+					self.stats['failed'] += 1
+
+	def snapshot(self):
+		with self.cond:
+			stats = dict(self.stats)
+			stats['pending'] = len(self.heap)
+			return stats
+
+
+class TasksServer(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, address=('127.0.0.1', 0), workers=4):
+		self.queue = TaskQueue(workers)
+		server = self
+
+		class Handler(BaseHTTPRequestHandler):
+			def reply(self, status, body=None):
+				data = json.dumps(body).encode('utf-8') if body is not None else b''
+				self.send_response(status)
+				self.send_header('Content-Type', 'application/json')
+				self.send_header('Content-Length', str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+
+			def do_POST(self):
+				if self.path != '/tasks':
+					return self.reply(404, {'Error': 'Not found'})
+				task = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+				if not server.queue.add(task):
+					return self.reply(409, {'Error': 'A task with this name already exists.'})
+				self.reply(200, {'name': task.get('name')})
+
+			def do_GET(self):
+				if self.path != '/tasks':
+					return self.reply(404, {'Error': 'Not found'})
+				self.reply(200, server.queue.snapshot())
+
+			def log_message(self, *args):
+				pass
+
+		ThreadingHTTPServer.__init__(self, address, Handler)
+
+	@property
+	def url(self):
+		return 'http://127.0.0.1:%d' % self.server_address[1]
+
+	def start(self):
+		threading.Thread(target=self.serve_forever, daemon=True).start()
+		return self
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--port', type=int, default=8123)
+	parser.add_argument('--workers', type=int, default=4)
+	args = parser.parse_args()
+	server = TasksServer(('127.0.0.1', args.port), args.workers)
+	print('Task queue stand-in listening on ' + server.url)
+	server.serve_forever()